@@ -0,0 +1,593 @@
+"""
+Benchmark the stages of the analysis pipeline on synthetic data.
+
+Synthetic stat maps (3D and 4D, masked and unmasked, on various grids)
+and the JSON of the NeuroVault and NeuroSynth APIs are served by a local
+stub server, so that the benchmark needs neither the network nor the
+real data. Each stage of neurovault_datagrabber.py, and the computations
+of the plot_* scripts, is timed for several catalogue sizes, with its
+throughput and its peak resident memory (of the process and of its
+worker processes). The results are saved as JSON, and can be compared to
+those of a previous run:
+
+    python benchmark.py --sizes 20 100 --output new.json --compare old.json
+"""
+# License: BSD
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import platform
+import threading
+import argparse
+import datetime
+from urlparse import urlparse, parse_qsl
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+from scipy import ndimage
+import nibabel as nb
+
+from sklearn.decomposition import FastICA
+
+from neurovault_datagrabber import (get_images_with_collections_df,
+                                    download_and_resample,
+                                    resample_to_data_matrix,
+                                    get_resampled_files, get_frequency_maps,
+                                    EXTRAPOLATION_ITERATIONS)
+from download_store import DownloadStore
+from fileutils import mkdir_p, write_json
+from extrapolation import preprocess_image
+from data_matrix import build_data_matrix, load_data_matrix
+from decomposition import ReducedICA, reduce_dimension
+from group_stats import group_t_maps
+from neurosynth_client import DecodingClient, decodings_to_matrix
+from text_analysis import GROUPS, extract_documents, vectorize
+
+
+# The grids of the synthetic maps: (affine, shape)
+GRIDS = [
+    # MNI 2mm
+    (np.array([[-2., 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72],
+               [0, 0, 0, 1]]), (91, 109, 91)),
+    # MNI 3mm
+    (np.array([[-3., 0, 0, 90], [0, 3, 0, -126], [0, 0, 3, -72],
+               [0, 0, 0, 1]]), (61, 73, 61)),
+    # Anisotropic voxels, another field of view
+    (np.array([[3., 0, 0, -96], [0, 3, 0, -132], [0, 0, 3.5, -78],
+               [0, 0, 0, 1]]), (64, 76, 46)),
+    # Oblique: rotated by 10 degrees around z
+    (np.array([[2.95, -.52, 0, -80], [.52, 2.95, 0, -120], [0, 0, 3, -72],
+               [0, 0, 0, 1]]), (60, 72, 58)),
+]
+
+MAP_TYPES = ('Z map', 'T map', 'F map')
+
+FILLER_WORDS = ('task', 'contrast', 'versus', 'baseline', 'condition',
+                'subjects', 'fixation', 'response', 'block', 'event')
+
+
+def _ellipsoid(shape, scale=.4):
+    """ A boolean ellipsoid filling the center of a 3D grid """
+    x, y, z = np.ogrid[[slice(0, s) for s in shape[:3]]]
+    center = [(s - 1) / 2. for s in shape[:3]]
+    radii = [scale * s for s in shape[:3]]
+    return (((x - center[0]) / radii[0]) ** 2
+            + ((y - center[1]) / radii[1]) ** 2
+            + ((z - center[2]) / radii[2]) ** 2) <= 1
+
+
+def make_stat_map(image_id):
+    """ A synthetic stat map: smooth noise scaled to Z values.
+
+    The image_id determines the map: its grid, its number of volumes
+    (every 10th map is 4D) and whether it is masked (every 3rd map, with
+    NaNs or zeros out of the brain).
+    """
+    rng = np.random.RandomState(image_id)
+    affine, shape = GRIDS[image_id % len(GRIDS)]
+    n_volumes = 3 if image_id % 10 == 0 else 1
+    if n_volumes > 1:
+        shape = shape + (n_volumes, )
+    data = ndimage.gaussian_filter(rng.randn(*shape),
+                                   sigma=(2, 2, 2, 0)[:len(shape)])
+    data *= 3 / data.std()
+    if image_id % 3 == 0:
+        brain = _ellipsoid(shape)
+        fill = np.nan if image_id % 2 else 0
+        data[np.logical_not(brain)] = fill
+    return nb.Nifti1Image(data.astype(np.float32), affine)
+
+
+def _modify_date(record_id):
+    """ The modify_date of a record: the higher the id, the more recent
+    """
+    return (datetime.datetime(2015, 1, 1)
+            + datetime.timedelta(hours=record_id)).isoformat()
+
+
+def _words(rng, n_words):
+    vocabulary = [word for group in GROUPS for word in group] \
+        + list(FILLER_WORDS)
+    return ' '.join(rng.choice(vocabulary, size=n_words))
+
+
+class SyntheticCatalogue(object):
+    """ The synthetic NeuroVault catalogue served by the stub server
+
+    The files of the maps are generated on first access, in path, and
+    reused across catalogue sizes. Only the first n_images images (and
+    their collections) are listed by the API.
+
+    Parameters
+    ----------
+    path: string
+        The directory where the maps are generated
+    n_images: int
+        The size of the catalogue
+    images_per_collection: int
+        The number of images in each collection
+    n_terms: int
+        The number of terms in the NeuroSynth decodings
+    """
+
+    def __init__(self, path, n_images=10, images_per_collection=5,
+                 n_terms=500):
+        self.path = path
+        self.n_images = n_images
+        self.images_per_collection = images_per_collection
+        self.terms = ['term %03d' % idx for idx in range(n_terms)]
+        self._etags = dict()
+        self._lock = threading.Lock()
+        mkdir_p(path)
+
+    def image_record(self, image_id, base_url):
+        rng = np.random.RandomState(image_id)
+        collection_id = (image_id - 1) // self.images_per_collection + 1
+        return dict(id=image_id,
+                    url='%s/api/images/%i/' % (base_url, image_id),
+                    file='%s/media/images/%04d.nii.gz' % (base_url, image_id),
+                    collection='%s/api/collections/%i/' % (base_url,
+                                                           collection_id),
+                    map_type=MAP_TYPES[image_id % len(MAP_TYPES)],
+                    modify_date=_modify_date(image_id),
+                    name=_words(rng, 3),
+                    description=_words(rng, 20),
+                    contrast_definition=_words(rng, 4),
+                    contrast_definition_cogatlas=_words(rng, 2))
+
+    def collection_record(self, collection_id, base_url):
+        rng = np.random.RandomState(-collection_id)
+        return dict(id=collection_id,
+                    url='%s/api/collections/%i/' % (base_url, collection_id),
+                    modify_date=_modify_date(collection_id),
+                    name=_words(rng, 6),
+                    description=_words(rng, 40))
+
+    def page(self, endpoint, base_url, limit, offset, ordering=None):
+        """ A page of the API listing of the images or of the
+        collections, in the given ordering ('modify_date' or
+        '-modify_date'), or by id
+        """
+        if endpoint == 'images':
+            count = self.n_images
+            make_record = self.image_record
+        else:
+            count = (self.n_images - 1) // self.images_per_collection + 1
+            make_record = self.collection_record
+        ids = range(1, count + 1)
+        # The records are modified in the order of their ids
+        if ordering == '-modify_date':
+            ids.reverse()
+        ids = ids[offset:offset + limit]
+        return dict(count=count,
+                    results=[make_record(this_id, base_url)
+                             for this_id in ids])
+
+    def image_file(self, image_id):
+        """ The file of a map, generated if needed, and its ETag """
+        filename = os.path.join(self.path, '%04d.nii.gz' % image_id)
+        with self._lock:
+            if not image_id in self._etags:
+                if not os.path.exists(filename):
+                    make_stat_map(image_id).to_filename(filename)
+                with open(filename, 'rb') as f:
+                    self._etags[image_id] = \
+                        '"%s"' % hashlib.sha1(f.read()).hexdigest()
+        return filename, self._etags[image_id]
+
+    def decoding(self, image_id):
+        rng = np.random.RandomState(image_id)
+        return dict(data=[dict(analysis=term, r=r) for term, r in
+                          zip(self.terms, rng.uniform(-.3, .3,
+                                                      len(self.terms)))])
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        catalogue = self.server.catalogue
+        parts = [part for part in url.path.split('/') if part]
+        if parts[:1] == ['api'] and len(parts) == 2:
+            page = catalogue.page(parts[1], self.server.base_url,
+                                  int(query.get('limit', 100)),
+                                  int(query.get('offset', 0)),
+                                  query.get('ordering'))
+            self._send(json.dumps(page), 'application/json')
+        elif parts[:2] == ['media', 'images'] and len(parts) == 3:
+            image_id = int(parts[2].split('.')[0])
+            filename, etag = catalogue.image_file(image_id)
+            if self.headers.getheader('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            with open(filename, 'rb') as f:
+                self._send(f.read(), 'application/octet-stream',
+                           [('ETag', etag)])
+        elif parts[:2] == ['decode', 'data']:
+            self._send(json.dumps(catalogue.decoding(
+                                    int(query['neurovault']))),
+                       'application/json')
+        else:
+            self.send_error(404)
+
+
+class _StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_server(catalogue):
+    """ Serve the catalogue on a free local port, in a background
+    thread. Returns the server: its base_url is that of the APIs.
+    """
+    server = _StubServer(('127.0.0.1', 0), _StubHandler)
+    server.catalogue = catalogue
+    server.base_url = 'http://127.0.0.1:%i' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+###############################################################################
+# Measures
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _rss(pid):
+    """ The resident memory of a process, in bytes (0 if unknown) """
+    try:
+        with open('/proc/%i/statm' % pid) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+def _children(pid):
+    """ The pids of the children of a process """
+    children = list()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # The command may contain spaces: it is in parentheses
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+    return children
+
+
+class PeakMemory(threading.Thread):
+    """ Sample, in a background thread, the resident memory of this
+    process and of its children (eg the workers of a Pool), and keep the
+    peak of their sum.
+
+    Without /proc, the peak is the maximum resident memory of this
+    process since it started, as given by getrusage.
+    """
+
+    def __init__(self, interval=.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        pid = os.getpid()
+        rss = _rss(pid) + sum(_rss(child) for child in _children(pid))
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        if not os.path.exists('/proc/self/statm'):
+            return
+        while not self.done.is_set():
+            self.sample()
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        if not os.path.exists('/proc/self/statm'):
+            import resource
+            # kilobytes on Linux, bytes on OSX
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = peak if sys.platform == 'darwin' else 1024 * peak
+        return self.peak
+
+
+def measure(n_items, func, *args, **kwargs):
+    """ Run func, and return its output and a dictionary of measures:
+    wall time (s), throughput (items/s) and peak resident memory (MB)
+    """
+    memory = PeakMemory()
+    memory.start()
+    t0 = time.time()
+    try:
+        out = func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - t0
+        peak = memory.stop()
+    return out, dict(time=elapsed, n_items=n_items,
+                     throughput=n_items / elapsed if elapsed else None,
+                     peak_rss_mb=peak / 2. ** 20)
+
+
+###############################################################################
+# The stages
+
+def _extrapolate_all(images_df, dest_dir, cache_dir):
+    store = DownloadStore(os.path.join(dest_dir, 'original'), refresh=False)
+    for image_id in images_df['image_id']:
+        image_id = int(image_id)
+        entry = store.manifest.get(image_id)
+        preprocess_image(image_id,
+                         os.path.join(store.path, entry['file']),
+                         entry['sha1'], cache_dir,
+                         iterations=EXTRAPOLATION_ITERATIONS)
+
+
+def _ica(X, n_components, memory_limit=None):
+    if memory_limit is None:
+        ica = FastICA(n_components=n_components, random_state=42)
+    else:
+        ica = ReducedICA(n_components=n_components,
+                         memory_limit=memory_limit, random_state=42)
+    return ica.fit_transform(X.T)
+
+
+def _decode(images_df, base_url, cache_dir, n_jobs):
+    client = DecodingClient(cache_dir, url='%s/decode/data/' % base_url,
+                            n_jobs=n_jobs, max_rate=1e6)
+    neurovault_ids = [url.split('/')[-2] for url in images_df['url_image']]
+    return decodings_to_matrix(client.decode(neurovault_ids))
+
+
+def run_stages(server, dest_dir, mask_img, n_jobs=1):
+    """ Run all the stages on the catalogue of the server, in dest_dir.
+    Returns the dictionary of the measures of each stage.
+    """
+    results = dict()
+    base_url = server.base_url
+
+    images_df, results['fetch'] = measure(
+        server.catalogue.n_images, get_images_with_collections_df,
+        api_url=base_url + '/api', n_jobs=n_jobs)
+    n_images = len(images_df)
+
+    # An incremental fetch must return only the images modified since
+    since = _modify_date(n_images // 2)
+    new_df, results['incremental_fetch'] = measure(
+        n_images - n_images // 2, get_images_with_collections_df,
+        api_url=base_url + '/api', n_jobs=n_jobs, since=since)
+    expected = range(n_images // 2 + 1, n_images + 1)
+    fetched = sorted(new_df['image_id']) if len(new_df) else []
+    if fetched != expected:
+        raise RuntimeError('The incremental fetch since %s returned the '
+                           'images %s rather than %s'
+                           % (since, fetched, expected))
+
+    processed_df, results['download_and_resample'] = measure(
+        n_images, download_and_resample, images_df, dest_dir, mask_img,
+        n_jobs=n_jobs, resampled_format='nii')
+    n_volumes = len(processed_df)
+
+    _, results['extrapolation'] = measure(
+        n_images, _extrapolate_all, images_df, dest_dir,
+        tempfile.mkdtemp(dir=dest_dir))
+
+    _, results['sparse_resampling'] = measure(
+        n_images, resample_to_data_matrix, images_df, dest_dir,
+        os.path.join(dest_dir, 'sparse_matrix'), mask_img=mask_img)
+
+    _, results['frequency_maps'] = measure(
+        n_volumes, get_frequency_maps, processed_df, dest_dir, mask_img,
+        thresholds=(2, 3), tails=('positive', 'absolute'),
+        mask_img=mask_img, n_jobs=n_jobs)
+
+    _, results['masking'] = measure(
+        n_volumes, build_data_matrix,
+        get_resampled_files(processed_df, dest_dir),
+        processed_df['image_id'], mask_img, dest_dir,
+        volumes=processed_df['volume'], n_jobs=n_jobs)
+
+    X = load_data_matrix(dest_dir, mask_img)
+    n_components = max(1, min(20, n_volumes - 1))
+    _, results['ica'] = measure(n_volumes, _ica, X, n_components)
+    _, results['reduced_ica'] = measure(n_volumes, _ica, X, n_components,
+                                        memory_limit=64)
+    for backend in ('randomized', 'incremental'):
+        _, results['pca_%s' % backend] = measure(
+            n_volumes, reduce_dimension, X, n_components, backend=backend)
+
+    term_freq, results['text_vectorization'] = measure(
+        n_volumes, lambda df: vectorize(extract_documents(df)),
+        processed_df)
+    _, results['group_t_maps'] = measure(n_volumes, group_t_maps, X,
+                                         term_freq != 0)
+
+    _, results['decoding'] = measure(n_volumes, _decode, processed_df,
+                                     base_url,
+                                     os.path.join(dest_dir, 'neurosynth'),
+                                     n_jobs)
+    return results
+
+
+def write_mask(filename):
+    """ A synthetic grey matter mask on the MNI 2mm grid, used also as
+    the target of the resampling
+    """
+    affine, shape = GRIDS[0]
+    nb.Nifti1Image(_ellipsoid(shape, scale=.35).astype(np.uint8),
+                   affine).to_filename(filename)
+
+
+###############################################################################
+# Reports
+
+def scaling_exponents(results, sizes):
+    """ For each stage, the exponent of the power law fitted to its time
+    as a function of the catalogue size (1 is linear scaling)
+    """
+    exponents = dict()
+    if len(sizes) < 2:
+        return exponents
+    for stage in results[str(sizes[0])]:
+        times = [results[str(size)][stage]['time'] for size in sizes]
+        if min(times) > 0:
+            exponents[stage] = np.polyfit(np.log(sizes), np.log(times),
+                                          1)[0]
+    return exponents
+
+
+def print_report(report):
+    sizes = report['sizes']
+    stages = sorted(report['results'][str(sizes[0])])
+    print '%-24s %8s %10s %12s %10s' % ('stage', 'size', 'time (s)',
+                                        'items/s', 'peak (MB)')
+    for stage in stages:
+        for size in sizes:
+            measures = report['results'][str(size)][stage]
+            print '%-24s %8i %10.2f %12.1f %10.0f' % (
+                stage, size, measures['time'],
+                measures['throughput'] or 0, measures['peak_rss_mb'])
+        if stage in report['scaling']:
+            print '%-24s scaling exponent: %.2f' % ('',
+                                                     report['scaling'][stage])
+
+
+def compare(report, previous, tolerance=.2):
+    """ Print the ratio of the times of this run to those of a previous
+    run, flagging the regressions. Returns the list of the regressions.
+    """
+    regressions = list()
+    print 'Compared to the run of %s:' % previous.get('date')
+    for size, stages in sorted(report['results'].items()):
+        old_stages = previous['results'].get(size, dict())
+        for stage, measures in sorted(stages.items()):
+            if not stage in old_stages or not old_stages[stage]['time']:
+                continue
+            ratio = measures['time'] / old_stages[stage]['time']
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = 'REGRESSION'
+                regressions.append((stage, int(size), ratio))
+            print '%-24s %8s %8.2fx %s' % (stage, size, ratio, flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50],
+                        help='the catalogue sizes (number of images)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='the number of parallel jobs of the stages')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='the JSON file of the results')
+    parser.add_argument('--compare', default=None,
+                        help='the JSON file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=.2,
+                        help='the relative slow down flagged as regression')
+    parser.add_argument('--work-dir', default=None,
+                        help='where the data is generated (a temporary '
+                             'directory, removed at the end, if not given)')
+    args = parser.parse_args(argv)
+
+    # Do not send the requests to the stub server through a proxy
+    os.environ['no_proxy'] = ','.join(
+        [value for value in (os.environ.get('no_proxy'), '127.0.0.1')
+         if value])
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='neurovault_benchmark')
+    else:
+        mkdir_p(work_dir)
+    sizes = sorted(args.sizes)
+
+    catalogue = SyntheticCatalogue(os.path.join(work_dir, 'maps'))
+    # Generate the maps beforehand, rather than during the downloads
+    for image_id in range(1, sizes[-1] + 1):
+        catalogue.image_file(image_id)
+    server = start_stub_server(catalogue)
+    mask_img = os.path.join(work_dir, 'mask.nii.gz')
+    write_mask(mask_img)
+    results = dict()
+    try:
+        for size in sizes:
+            print 'Catalogue of %i images' % size
+            catalogue.n_images = size
+            dest_dir = os.path.join(work_dir, 'run_%i' % size)
+            if os.path.exists(dest_dir):
+                shutil.rmtree(dest_dir)
+            mkdir_p(dest_dir)
+            results[str(size)] = run_stages(server, dest_dir, mask_img,
+                                            n_jobs=args.jobs)
+    finally:
+        server.shutdown()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = dict(date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  python=sys.version, platform=platform.platform(),
+                  numpy=np.__version__, jobs=args.jobs, sizes=sizes,
+                  results=results,
+                  scaling=scaling_exponents(results, sizes))
+    write_json(args.output, report, indent=1)
+    print_report(report)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(report, previous, tolerance=args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
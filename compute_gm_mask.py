@@ -1,5 +1,6 @@
 """
-Compute a grey matter mask from the SPM Tissue Probability Masks
+Compute a grey matter mask from the SPM Tissue Probability Masks, and
+its pyramid of coarser masks (see mask_pyramid)
 """
 
 import os
@@ -9,6 +10,8 @@ from scipy import ndimage
 from nilearn.image import resample_img
 import nibabel
 
+from mask_pyramid import build_pyramid
+
 SPM_DIR = os.environ['SPM_DIR']
 
 grey_matter_template = os.path.join(SPM_DIR, 'tpm', 'grey.nii')
@@ -34,3 +37,7 @@ mask_img = nibabel.Nifti1Image(gm_mask, affine)
 
 nibabel.save(mask_img, 'gm_mask.nii.gz')
 
+# gm_mask_3mm.nii.gz, gm_mask_4mm.nii.gz, and the indices between the
+# levels in gm_mask_pyramid.npz
+build_pyramid('gm_mask.nii.gz')
+
@@ -0,0 +1,194 @@
+""" The masked data matrix (n_images x n_voxels) of the resampled maps,
+stored once as a float32 array on disk, and memory-mapped by the analysis
+scripts.
+
+The matrix is stored in 'data_matrix.npy', next to 'metadata.csv', with
+a 'data_matrix.json' header giving the image_id of each row, the number
+of rows, and the hashes of the mask and of the content. Both are written
+to temporary files and renamed: a reader finding a header that does not
+match the matrix (one of them being rewritten) gets an error.
+"""
+# License: BSD
+
+import os
+import json
+import hashlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+
+from fileutils import tmp_filename, write_json
+
+
+def mask_hash(mask_img):
+    """ A hash of a mask image: its voxels and its affine """
+    mask_nii = nb.load(mask_img)
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(
+                    mask_nii.get_data().astype(np.bool)).tostring())
+    hasher.update(str(mask_nii.shape))
+    hasher.update(np.ascontiguousarray(
+                    mask_nii.get_affine(), dtype=np.float).tostring())
+    return hasher.hexdigest()
+
+
+def write_data_matrix(rows, image_ids, mask_img, data_dir):
+    """ Write the data matrix in data_dir, from an iterable of rows (the
+    masked images, in the order of image_ids)
+    """
+    n_voxels = nb.load(mask_img).get_data().astype(np.bool).sum()
+    filename = os.path.join(data_dir, 'data_matrix.npy')
+    tmp_file = tmp_filename(filename)
+    X = np.lib.format.open_memmap(tmp_file, mode='w+',
+                                  dtype=np.float32,
+                                  shape=(len(image_ids), n_voxels))
+    # A hash of the content, for the caches of the analyses
+    hasher = hashlib.sha1()
+    try:
+        for idx, row in enumerate(rows):
+            X[idx] = row
+            hasher.update(X[idx].tostring())
+        X.flush()
+        del X
+    except:
+        os.remove(tmp_file)
+        raise
+    os.rename(tmp_file, filename)
+
+    header = dict(image_ids=[int(i) for i in image_ids],
+                  n_rows=len(image_ids),
+                  mask_hash=mask_hash(mask_img),
+                  data_hash=hasher.hexdigest())
+    write_json(os.path.join(data_dir, 'data_matrix.json'), header)
+
+
+def _prefetch(load, items, n_jobs):
+    """ Iterate over load(item) for the items, loading up to 2 * n_jobs
+    items ahead in n_jobs threads (decompression releases the GIL)
+    """
+    if n_jobs == 1:
+        for item in items:
+            yield load(item)
+        return
+    pool = ThreadPool(n_jobs)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(load, (item, )))
+            if len(pending) > 2 * n_jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def iter_volumes(files, volumes=None, load=None, n_jobs=1):
+    """ Iterate over the 3D data of the given volumes of the given files
+
+    For a 4D file, the volume is selected in its last dimension, and
+    consecutive volumes of the same file are read from a single load.
+    Files are decoded in parallel by n_jobs threads.
+    """
+    if load is None:
+        load = lambda this_file: nb.load(this_file).get_data()
+    if volumes is None:
+        volumes = [0] * len(files)
+    # Group the consecutive volumes of a same file
+    runs = list()
+    for this_file, volume in zip(files, volumes):
+        if not runs or runs[-1][0] != this_file:
+            runs.append((this_file, list()))
+        runs[-1][1].append(volume)
+    for (_, these_volumes), data in zip(runs,
+                                        _prefetch(load,
+                                                  [run[0] for run in runs],
+                                                  n_jobs)):
+        for volume in these_volumes:
+            if data.ndim > 3:
+                yield data[..., volume]
+            else:
+                yield data
+
+
+def build_data_matrix(files, image_ids, mask_img, data_dir, volumes=None,
+                      n_jobs=1):
+    """ Mask the given images (or volumes of 4D images), one at a time,
+    and write the resulting matrix in data_dir. The images are read by
+    n_jobs threads.
+    """
+    mask = nb.load(mask_img).get_data().astype(np.bool)
+    write_data_matrix((data[mask] for data in iter_volumes(list(files),
+                                                           volumes,
+                                                           n_jobs=n_jobs)),
+                      list(image_ids), mask_img, data_dir)
+
+
+def standardize_rows(X):
+    """ The rows of X centered and scaled to unit variance, in float32.
+    Constant rows are set to 0, and so are non finite values.
+    """
+    X = np.array(X, dtype=np.float32)
+    X[np.logical_not(np.isfinite(X))] = 0
+    X -= X.mean(axis=1)[:, np.newaxis]
+    std = X.std(axis=1)
+    std[std == 0] = 1
+    X /= std[:, np.newaxis]
+    return X
+
+
+def read_header(data_dir):
+    with open(os.path.join(data_dir, 'data_matrix.json')) as f:
+        return json.load(f)
+
+
+def data_hash(data_dir):
+    """ The hash of the content of the data matrix, from its header, or
+    computed from the matrix for matrices written before the header had
+    it
+    """
+    this_hash = read_header(data_dir).get('data_hash')
+    if this_hash is None:
+        X = np.load(os.path.join(data_dir, 'data_matrix.npy'),
+                    mmap_mode='r')
+        hasher = hashlib.sha1()
+        for row in X:
+            hasher.update(np.asarray(row, dtype=np.float32).tostring())
+        this_hash = hasher.hexdigest()
+    return this_hash
+
+
+def load_data_matrix(data_dir, mask_img, image_ids=None):
+    """ Load the data matrix memory-mapped, read-only
+
+    Parameters
+    ----------
+    data_dir: string
+        The directory where the matrix was built
+    mask_img: string
+        The mask of the analysis: it must be the one the matrix was built
+        with
+    image_ids: list of ints, optional
+        The image_ids of the rows to return, in this order. If they are
+        the rows of the matrix, in the same order, the matrix is not
+        copied.
+    """
+    header = read_header(data_dir)
+    if header['mask_hash'] != mask_hash(mask_img):
+        raise ValueError('The data matrix in %s was built with another '
+                         'mask than %s' % (data_dir, mask_img))
+    X = np.load(os.path.join(data_dir, 'data_matrix.npy'), mmap_mode='r')
+    if len(header['image_ids']) != X.shape[0]:
+        raise ValueError('The data matrix in %s has %i rows, but its '
+                         'header %i: is it being rewritten?'
+                         % (data_dir, X.shape[0], len(header['image_ids'])))
+    if image_ids is None:
+        return X
+    image_ids = [int(i) for i in image_ids]
+    if image_ids == header['image_ids']:
+        return X
+    rows = dict((image_id, row)
+                for row, image_id in enumerate(header['image_ids']))
+    return X[[rows[image_id] for image_id in image_ids]]
@@ -0,0 +1,163 @@
+""" Decompositions and embeddings of the data matrix, with backends that
+scale to catalogues that do not fit in memory.
+"""
+# License: BSD
+
+import numpy as np
+
+from sklearn.decomposition import PCA, FastICA, IncrementalPCA
+from sklearn.utils.extmath import randomized_svd
+
+
+def _chunks(n_samples, chunk_size, min_size):
+    """ Slices of at most chunk_size samples, but at least min_size """
+    n_chunks = max(1, min(n_samples // max(chunk_size, 1) + 1,
+                          n_samples // max(min_size, 1)))
+    bounds = np.linspace(0, n_samples, n_chunks + 1).astype(np.int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1],
+                                                      bounds[1:])]
+
+
+def _chunk_size(memory_limit, n_features):
+    """ The number of samples per chunk so that a chunk, and its copies
+    by an IncrementalPCA, use at most memory_limit MB
+    """
+    # The PCA works in float64, and makes a few copies of a chunk
+    return int(memory_limit * 2 ** 20 / (4 * 8 * n_features))
+
+
+class ReducedICA(object):
+    """ FastICA on data first reduced with an IncrementalPCA streamed
+    over chunks of samples
+
+    Only one chunk of the data, and the reduced data, are held in
+    memory. The interface mimics that of FastICA.
+
+    Parameters
+    ----------
+    n_components: int
+        The number of independent components
+    n_reduced: int, optional
+        The number of principal components kept before the ICA. Defaults
+        to twice n_components.
+    chunk_size: int, optional
+        The number of samples per chunk. If not given, it is derived from
+        memory_limit.
+    memory_limit: float
+        The memory (in MB) that a chunk, and its copies by the PCA, can
+        use.
+    random_state: int or RandomState, optional
+        Passed to FastICA
+
+    Attributes
+    ----------
+    components_: array, (n_components, n_features)
+        The unmixing matrix, in the space of the original features
+    """
+
+    def __init__(self, n_components=20, n_reduced=None, chunk_size=None,
+                 memory_limit=1024, random_state=None):
+        self.n_components = n_components
+        self.n_reduced = n_reduced
+        self.chunk_size = chunk_size
+        self.memory_limit = memory_limit
+        self.random_state = random_state
+
+    def fit_transform(self, X):
+        n_samples, n_features = X.shape
+        n_reduced = self.n_reduced
+        if n_reduced is None:
+            n_reduced = 2 * self.n_components
+        n_reduced = min(n_reduced, n_features)
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = _chunk_size(self.memory_limit, n_features)
+        chunks = _chunks(n_samples, chunk_size, n_reduced)
+
+        pca = IncrementalPCA(n_components=n_reduced)
+        for chunk in chunks:
+            pca.partial_fit(np.asarray(X[chunk], dtype=np.float))
+        X_reduced = np.empty((n_samples, n_reduced), dtype=np.float32)
+        for chunk in chunks:
+            X_reduced[chunk] = pca.transform(np.asarray(X[chunk],
+                                                        dtype=np.float))
+
+        ica = FastICA(n_components=self.n_components,
+                      random_state=self.random_state)
+        sources = ica.fit_transform(X_reduced)
+        self.pca_ = pca
+        self.ica_ = ica
+        self.components_ = np.dot(ica.components_, pca.components_)
+        return sources
+
+
+def reduce_dimension(X, n_components, backend='randomized',
+                     chunk_size=None, memory_limit=1024, random_state=0):
+    """ Project the rows of X on their first principal components
+
+    Parameters
+    ----------
+    X: array, (n_samples, n_features)
+        The data
+    n_components: int
+        The number of principal components
+    backend: 'randomized', 'incremental' or 'exact'
+        'randomized' uses a randomized SVD, 'incremental' an
+        IncrementalPCA on chunks of chunk_size samples, 'exact' a full
+        PCA
+    chunk_size: int, optional
+        The number of samples per chunk of the 'incremental' backend. If
+        not given, it is derived from memory_limit.
+    memory_limit: float
+        The memory (in MB) that a chunk, and its copies by the PCA, can
+        use, in the 'incremental' backend
+    """
+    if backend == 'exact':
+        return PCA(n_components=n_components).fit_transform(X)
+    elif backend == 'randomized':
+        X = np.asarray(X)
+        U, S, _ = randomized_svd(X - X.mean(axis=0), n_components,
+                                 random_state=random_state)
+        return U * S
+    elif backend == 'incremental':
+        if chunk_size is None:
+            chunk_size = _chunk_size(memory_limit, X.shape[1])
+        chunks = _chunks(X.shape[0], chunk_size, n_components)
+        pca = IncrementalPCA(n_components=n_components)
+        for chunk in chunks:
+            pca.partial_fit(np.asarray(X[chunk], dtype=np.float))
+        return np.concatenate([pca.transform(np.asarray(X[chunk],
+                                                        dtype=np.float))
+                               for chunk in chunks])
+    raise ValueError("Unknown backend %r, should be 'randomized', "
+                     "'incremental' or 'exact'" % backend)
+
+
+def compute_embedding(X, data_key, method='pca', n_components=3,
+                      n_reduced=50, backend='randomized', **params):
+    """ Embed the rows of X in n_components dimensions
+
+    'pca' projects the data on its principal components, 'tsne' and 'mds'
+    are run on the data reduced to n_reduced principal components, with
+    the given params. The PCAs use the given backend (see
+    reduce_dimension).
+
+    data_key identifies X (eg the hash of the data matrix and the list of
+    image_ids), so that the embedding can be cached without hashing X:
+
+        mem.cache(compute_embedding, ignore=['X'])
+    """
+    if method == 'pca':
+        return reduce_dimension(X, n_components, backend=backend)
+    X_reduced = reduce_dimension(X, min(n_reduced, min(X.shape)),
+                                 backend=backend).astype(np.float64)
+    if method == 'tsne':
+        from sklearn.manifold import TSNE
+        return TSNE(n_components=n_components,
+                    **params).fit_transform(X_reduced)
+    elif method == 'mds':
+        from sklearn.manifold import MDS
+        return MDS(n_components=n_components,
+                   **params).fit_transform(X_reduced)
+    raise ValueError("Unknown method %r, should be 'pca', 'tsne' or 'mds'"
+                     % method)
@@ -0,0 +1,233 @@
+""" A store for the files downloaded from NeuroVault.
+
+Downloads go to a '.part' file that is renamed once complete, and can be
+resumed with an HTTP Range request if interrupted. A manifest records,
+for each image_id, the url, ETag, size and sha1 of the file, so that
+refreshing the store uses conditional GETs and only transfers the files
+that changed.
+"""
+# License: BSD
+
+import os
+import json
+import fcntl
+import hashlib
+import socket
+import httplib
+import threading
+from urllib2 import Request, urlopen, HTTPError, URLError
+
+from instrumentation import RunReport
+from fileutils import mkdir_p, write_json
+
+CHUNK_SIZE = 2 ** 20
+
+
+def _hash_file(filename, hasher=None):
+    if hasher is None:
+        hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            hasher.update(chunk)
+    return hasher
+
+
+class Manifest(object):
+    """ Entries indexed by image_id, saved to a JSON file every
+    flush_every updates, and by flush
+
+    Rewriting the whole file at each update would make building a
+    manifest quadratic in the number of images: the users of a manifest
+    flush it when they are done (in a finally clause). Updates are thread
+    safe, and the file is written to a temporary file and renamed, so
+    that it is never left half written.
+
+    Several processes can share a manifest (eg stages run in parallel on
+    the same cache): on writing, the file is read again and the pending
+    updates merged into it, under a lock file, so that the entries of the
+    other processes are kept.
+    """
+
+    def __init__(self, filename, flush_every=100):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.entries = dict()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+        self._lock = threading.Lock()
+        # The updates not written yet, by image_id
+        self._pending = dict()
+
+    def get(self, image_id, default=None):
+        return self.entries.get(str(image_id), default)
+
+    def update(self, image_id, **entry):
+        with self._lock:
+            self.entries.setdefault(str(image_id), dict()).update(entry)
+            self._pending.setdefault(str(image_id), dict()).update(entry)
+            if len(self._pending) >= self.flush_every:
+                self._write()
+
+    def flush(self):
+        """ Write the updates not saved yet """
+        with self._lock:
+            if self._pending:
+                self._write()
+
+    def _write(self):
+        with open(self.filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries = dict()
+                if os.path.exists(self.filename):
+                    with open(self.filename) as f:
+                        entries = json.load(f)
+                for image_id, entry in self._pending.items():
+                    entries.setdefault(image_id, dict()).update(entry)
+                write_json(self.filename, entries)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.entries = entries
+        self._pending = dict()
+
+
+class DownloadStore(object):
+    """ Files downloaded in a directory, indexed by image_id
+
+    Parameters
+    ----------
+    path: string
+        The directory where the files and the manifest are stored
+    refresh: boolean
+        If True, files already in the store are checked against the
+        server with a conditional GET. If False, they are trusted.
+    verify: boolean
+        If True, the sha1 of files already in the store is checked
+        against the manifest before they are used.
+    timeout: float
+        The timeout of the requests, in seconds
+    report: RunReport, optional
+        Where the bytes downloaded and the cache hits are counted (see
+        instrumentation)
+    """
+
+    def __init__(self, path, refresh=True, verify=False, timeout=60.,
+                 report=None):
+        self.path = path
+        self.refresh = refresh
+        self.verify = verify
+        self.timeout = timeout
+        if report is None:
+            report = RunReport(progress_interval=None)
+        self.report = report
+        mkdir_p(path)
+        self.manifest = Manifest(os.path.join(path, 'manifest.json'))
+
+    def is_intact(self, image_id):
+        """ Whether the file of the image is in the store, complete, and
+        (if self.verify) has the sha1 recorded in the manifest.
+        """
+        entry = self.manifest.get(image_id)
+        if entry is None or not 'sha1' in entry:
+            return False
+        filename = os.path.join(self.path, entry['file'])
+        if (not os.path.exists(filename)
+                or os.path.getsize(filename) != entry['size']):
+            return False
+        if self.verify:
+            return _hash_file(filename).hexdigest() == entry['sha1']
+        return True
+
+    def sha1(self, image_id):
+        """ The sha1 of the file of an image fetched in the store """
+        return self.manifest.get(image_id)['sha1']
+
+    def flush(self):
+        """ Save the manifest: call it when done fetching """
+        self.manifest.flush()
+
+    def fetch(self, image_id, url, filename):
+        """ Return the path of the file of an image, downloading it to
+        'filename' (relative to the store) if needed.
+        """
+        dest = os.path.join(self.path, filename)
+        part = dest + '.part'
+        entry = self.manifest.get(image_id, dict())
+        intact = (entry.get('url') == url and entry.get('file') == filename
+                  and self.is_intact(image_id))
+        if intact and not self.refresh:
+            self.report.count('download.cache_hit')
+            return dest
+
+        request = Request(url)
+        if intact:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since',
+                                   entry['last_modified'])
+        offset = 0
+        if os.path.exists(part) and entry.get('part_url') == url:
+            offset = os.path.getsize(part)
+        if offset:
+            request.add_header('Range', 'bytes=%i-' % offset)
+            if entry.get('part_etag'):
+                # Only resume if the file did not change meanwhile
+                request.add_header('If-Range', entry['part_etag'])
+
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                # Not modified
+                self.report.count('download.cache_hit')
+                return dest
+            if e.code == 416 and offset:
+                # The partial file is not consistent with the server
+                os.remove(part)
+                self.manifest.update(image_id, part_url=None)
+                return self.fetch(image_id, url, filename)
+            raise
+        except (URLError, socket.error, httplib.HTTPException):
+            if intact:
+                # We are offline, but have a good copy
+                self.report.count('download.offline_hit')
+                return dest
+            raise
+
+        print "Downloading %s" % dest
+        self.report.count('download.cache_miss')
+        try:
+            info = response.info()
+            etag = info.getheader('ETag')
+            if response.getcode() == 206:
+                hasher = _hash_file(part)
+                mode = 'ab'
+                self.report.count('download.resumed')
+            else:
+                # The server sent the full file
+                hasher = hashlib.sha1()
+                mode = 'wb'
+                offset = 0
+            self.manifest.update(image_id, part_url=url, part_etag=etag)
+            with open(part, mode) as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    self.report.count('download.bytes', len(chunk))
+        finally:
+            response.close()
+
+        size = os.path.getsize(part)
+        length = info.getheader('Content-Length')
+        if length is not None and size != offset + int(length):
+            # Keep the partial file, to resume the download later
+            raise IOError('Truncated download of %s: %i bytes out of %i'
+                          % (url, size, offset + int(length)))
+        os.rename(part, dest)
+        self.manifest.update(image_id, url=url, file=filename, etag=etag,
+                             last_modified=info.getheader('Last-Modified'),
+                             size=size, sha1=hasher.hexdigest(),
+                             part_url=None, part_etag=None)
+        return dest
@@ -0,0 +1,140 @@
+""" Detection of masked stat maps, and extrapolation of their values out of
+the brain, before resampling.
+
+The decision (masked or not) and the extrapolated data are cached per
+image, keyed on the sha1 of the original file and the parameters, so
+that re-runs and parameter sweeps do not redo them.
+"""
+# License: BSD
+
+import os
+import json
+
+import numpy as np
+from scipy import ndimage
+import nibabel as nb
+
+from nilearn.masking import compute_background_mask
+
+from fileutils import tmp_filename, write_json
+
+
+def is_masked(data, bg_mask):
+    """ Whether the image has been masked: the values out of the brain are
+    all NaN, or all equal
+    """
+    out_of_mask = data[np.logical_not(bg_mask)].ravel()
+    nans = np.isnan(out_of_mask)
+    if np.all(nans):
+        return True
+    if np.any(nans):
+        return False
+    return bool(np.all(out_of_mask == out_of_mask[0]))
+
+
+def _bounding_box(mask, margin):
+    """ The slices of the bounding box of the mask, grown by margin """
+    coords = np.where(mask)
+    if not len(coords[0]):
+        return tuple(slice(None) for _ in mask.shape)
+    return tuple(slice(max(0, c.min() - margin), c.max() + 1 + margin)
+                 for c in coords)
+
+
+def _extrapolate_shell(data, mask):
+    """ Give to the voxels just outside the mask the mean of their
+    neighbors in the mask. Voxels further away are set to 0.
+    """
+    new_mask = ndimage.binary_dilation(mask)
+    shell = np.logical_and(new_mask, np.logical_not(mask))
+    # NaN outside of the mask, and in the padding
+    values = np.array(data, copy=True)
+    values[np.logical_not(mask)] = np.nan
+    padding = [(1, 1)] * 3 + [(0, 0)] * (data.ndim - 3)
+    values = np.pad(values, padding, mode='constant',
+                    constant_values=np.nan)
+    x, y, z = np.where(shell)
+    neighbors = np.array([values[x + 1 + i, y + 1 + j, z + 1 + k]
+                          for i, j, k in [(1, 0, 0), (-1, 0, 0),
+                                          (0, 1, 0), (0, -1, 0),
+                                          (0, 0, 1), (0, 0, -1)]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        extrapolation = (np.nansum(neighbors, axis=0)
+                         / np.sum(np.isfinite(neighbors), axis=0))
+    extrapolation[np.logical_not(np.isfinite(extrapolation))] = 0
+    new_data = np.zeros_like(data)
+    new_data[mask] = data[mask]
+    new_data[shell] = extrapolation
+    return new_data, new_mask
+
+
+def extrapolate_out_mask(data, mask, iterations=3):
+    """ Extrapolate the data out of the mask, one voxel per iteration, in
+    float32, working only on the bounding box of the mask.
+
+    Gives the same result as nilearn.masking._extrapolate_out_mask.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    mask = np.asarray(mask, dtype=np.bool)
+    box = _bounding_box(mask, iterations + 1)
+    box_data = data[box]
+    box_mask = mask[box]
+    for _ in range(iterations):
+        box_data, box_mask = _extrapolate_shell(box_data, box_mask)
+    out = np.zeros_like(data)
+    out[box] = box_data
+    return out
+
+
+def preprocess_image(image_id, orig_file, sha1, cache_dir, iterations=3):
+    """ Load a stat map and, if it has been masked, extrapolate it out of
+    the brain. Returns a Nifti1Image.
+
+    The decision, and the extrapolated image, are cached in cache_dir.
+    """
+    decision_file = os.path.join(cache_dir, '%04d.json' % image_id)
+    cache_file = os.path.join(cache_dir, '%04d.nii' % image_id)
+    key = dict(sha1=sha1, iterations=iterations)
+    decision = None
+    if os.path.exists(decision_file):
+        with open(decision_file) as f:
+            decision = json.load(f)
+        if decision['key'] != key:
+            decision = None
+
+    if decision is not None and decision['masked']:
+        if os.path.exists(cache_file):
+            try:
+                niimg = nb.load(cache_file)
+                # Read it now, to check that it is complete
+                niimg.get_data()
+                return niimg
+            except (IOError, ValueError, EOFError) as e:
+                print "Could not load %s, extrapolating again: %s" % (
+                                                        cache_file, e)
+    niimg = nb.load(orig_file)
+    data = niimg.get_data().squeeze()
+    niimg = nb.Nifti1Image(data, niimg.get_affine(),
+                           header=niimg.get_header())
+    if decision is not None and not decision['masked']:
+        return niimg
+
+    print "Extrapolating %s" % orig_file
+    bg_mask = compute_background_mask(niimg).get_data()
+    if decision is None:
+        decision = dict(key=key, masked=is_masked(data, bg_mask))
+        write_json(decision_file, decision)
+    if not decision['masked']:
+        return niimg
+
+    data = extrapolate_out_mask(data, bg_mask, iterations=iterations)
+    # Saved as float32: with the dtype of the original header (eg int16
+    # with a scl_slope), the extrapolated values would be quantized
+    header = niimg.get_header().copy()
+    header.set_data_dtype(np.float32)
+    niimg = nb.Nifti1Image(data, niimg.get_affine(), header=header)
+    # Save uncompressed: it is reloaded rather than recomputed
+    tmp_file = tmp_filename(cache_file)
+    niimg.to_filename(tmp_file)
+    os.rename(tmp_file, cache_file)
+    return niimg
@@ -0,0 +1,180 @@
+""" Rendering of the figures of brain maps, in parallel and incrementally.
+
+A figure is an image (a filename or a Nifti1Image), the files it is
+saved to, and its spec: a JSON-compatible dictionary of the parameters
+of the plot:
+
+* 'kind': 'stat_map' (plot_stat_map, the default), or 'overlay' (the
+  image overlaid on plot_anat)
+* 'bg_img': the background (the MNI template if None)
+* 'title', 'title_size': the title of the display
+* 'percent_ticks': if True, the labels of the colorbar are rounded to
+  integers (eg for percentages)
+* the other entries are passed to plot_stat_map, or to add_overlay
+  ('display_mode' and 'cut_coords' to plot_anat), with 'cmap' given by
+  its name
+
+The figures are rendered by a pool of processes, with the Agg backend,
+and each process loads each background once. A manifest records the
+hash of the image and the spec of each figure rendered: figures whose
+image and spec are unchanged, and whose files exist, are not rendered
+again.
+"""
+# License: BSD
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nb
+
+from download_store import Manifest
+
+Figure = namedtuple('Figure', ('img', 'outputs', 'spec'))
+
+
+def image_hash(img):
+    """ A hash of an image (filename or Nifti1Image): its data and its
+    affine
+    """
+    if isinstance(img, basestring):
+        img = nb.load(img)
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(img.get_data(),
+                                       dtype=np.float32).tostring())
+    hasher.update(str(img.shape))
+    hasher.update(np.ascontiguousarray(img.get_affine(),
+                                       dtype=np.float).tostring())
+    return hasher.hexdigest()
+
+
+###############################################################################
+# In the worker processes
+
+# The backgrounds loaded, by filename
+_BACKGROUNDS = dict()
+
+
+def _init_worker():
+    from matplotlib import pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _background(bg_img):
+    if bg_img not in _BACKGROUNDS:
+        if bg_img is None:
+            from nilearn.plotting.img_plotting import MNI152TEMPLATE
+            MNI152TEMPLATE.load()
+            _BACKGROUNDS[bg_img] = MNI152TEMPLATE
+        else:
+            bg_nii = nb.load(bg_img)
+            _BACKGROUNDS[bg_img] = nb.Nifti1Image(bg_nii.get_data(),
+                                                  bg_nii.get_affine())
+    return _BACKGROUNDS[bg_img]
+
+
+def render_figure(img, outputs, spec):
+    """ Render a figure, and save it to the files outputs """
+    from matplotlib import pyplot as plt
+    from nilearn.plotting import plot_stat_map, plot_anat
+
+    spec = dict(spec)
+    kind = spec.pop('kind', 'stat_map')
+    title = spec.pop('title', None)
+    title_kwargs = dict()
+    if 'title_size' in spec:
+        title_kwargs['size'] = spec.pop('title_size')
+    percent_ticks = spec.pop('percent_ticks', False)
+    bg_img = _background(spec.pop('bg_img', None))
+    if 'cmap' in spec:
+        spec['cmap'] = plt.get_cmap(spec['cmap'])
+
+    if kind == 'overlay':
+        display = plot_anat(bg_img,
+                            display_mode=spec.pop('display_mode', 'ortho'),
+                            cut_coords=spec.pop('cut_coords', None))
+        display.add_overlay(img, **spec)
+    else:
+        display = plot_stat_map(img, bg_img=bg_img, **spec)
+    if percent_ticks:
+        display._colorbar_ax.set_yticklabels(["% 3i" % float(t.get_text())
+            for t in display._colorbar_ax.yaxis.get_ticklabels()])
+    if title is not None:
+        display.title(title, **title_kwargs)
+    for output in outputs:
+        display.savefig(output)
+    display.close()
+    return outputs
+
+
+###############################################################################
+# In the main process
+
+def render_figures(figures, manifest_file='figures.json', n_jobs=1,
+                   force=False):
+    """ Render the figures that are not up to date
+
+    Parameters
+    ----------
+    figures: list of Figure
+        The figures (see the module docstring for their specs)
+    manifest_file: string
+        The manifest of the figures rendered
+    n_jobs: int
+        The number of rendering processes
+    force: boolean
+        If True, all the figures are rendered
+
+    Returns
+    -------
+    The list of the outputs of the figures rendered
+    """
+    manifest = Manifest(manifest_file)
+    jobs = list()
+    for img, outputs, spec in figures:
+        outputs = list(outputs)
+        # The JSON round trip, to compare with the manifest
+        spec = json.loads(json.dumps(spec))
+        this_hash = image_hash(img)
+        entry = manifest.get(outputs[0])
+        if (not force and entry is not None
+                and entry['image_hash'] == this_hash
+                and entry['spec'] == spec and entry['outputs'] == outputs
+                and all(os.path.exists(output) for output in outputs)):
+            continue
+        if not isinstance(img, basestring):
+            # Send the data, not a proxy to a file
+            img = nb.Nifti1Image(np.asarray(img.get_data()),
+                                 img.get_affine())
+        jobs.append((img, outputs, spec, this_hash))
+    if not jobs:
+        print "All the %i figures are up to date" % len(figures)
+        return []
+
+    rendered = list()
+    n_rendered = 0
+    # A pool even with one job, so that the backend of the main process
+    # is left alone
+    pool = Pool(n_jobs, initializer=_init_worker)
+    try:
+        results = [pool.apply_async(render_figure, (img, outputs, spec))
+                   for img, outputs, spec, _ in jobs]
+        for (_, outputs, spec, this_hash), result in zip(jobs, results):
+            try:
+                result.get()
+            except Exception as e:
+                print "Could not render %s: %s" % (outputs[0], e)
+                continue
+            manifest.update(outputs[0], image_hash=this_hash, spec=spec,
+                            outputs=outputs)
+            rendered.extend(outputs)
+            n_rendered += 1
+    finally:
+        pool.terminate()
+        manifest.flush()
+    print "Rendered %i figures, %i up to date" % (n_rendered,
+                                                  len(figures) - len(jobs))
+    return rendered
@@ -0,0 +1,40 @@
+""" Helpers to write the files of a cache that several processes (eg
+stages of the pipeline run in parallel) can share: files are written to
+a temporary file unique to the process and the thread, then renamed, so
+that they are never seen half written.
+"""
+# License: BSD
+
+import os
+import json
+import errno
+import threading
+
+
+def mkdir_p(path):
+    """ Create the directory path, and its parents, if they do not exist """
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if not (exc.errno == errno.EEXIST and os.path.isdir(path)):
+            raise
+
+
+def tmp_filename(filename):
+    """ A temporary name for filename, in the same directory, unique to
+    the process and the thread, with the same extension (eg '.nii' or
+    '.npy', that nibabel and numpy rely on)
+    """
+    path, name = os.path.split(filename)
+    base, dot, ext = name.partition('.')
+    return os.path.join(path, '%s.%i-%i.tmp%s%s' % (
+                base, os.getpid(), threading.current_thread().ident,
+                dot, ext))
+
+
+def write_json(filename, content, **kwargs):
+    """ Write content as JSON to filename, through a temporary file """
+    tmp_file = tmp_filename(filename)
+    with open(tmp_file, 'w') as f:
+        json.dump(content, f, **kwargs)
+    os.rename(tmp_file, filename)
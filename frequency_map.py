@@ -0,0 +1,119 @@
+""" Accumulate maps of frequency of activation, in a single pass over
+the stat maps, for several thresholds, tails and map types at once.
+"""
+# License: BSD
+
+import numpy as np
+import nibabel as nb
+
+from nilearn.image import resample_img
+
+TAILS = ('absolute', 'positive', 'negative')
+
+
+def load_in_target(filename, target_affine, target_shape,
+                   interpolation='nearest'):
+    """ Load an image as an array in the target space, resampling it only
+    if it is not already there.
+    """
+    niimg = nb.load(filename)
+    if (niimg.shape[:3] != tuple(target_shape[:3])
+            or not np.allclose(niimg.get_affine(), target_affine)):
+        niimg = resample_img(niimg, target_affine, target_shape[:3],
+                             interpolation=interpolation)
+    return niimg.get_data()
+
+
+class FrequencyAccumulator(object):
+    """ Count, for each voxel of a mask, how many maps exceed some
+    thresholds
+
+    Counts are kept as int32 on the masked voxels only, for each map type
+    (and for all the maps together, under the map type 'all'), each tail
+    and each threshold.
+
+    Parameters
+    ----------
+    mask: 3D boolean array
+        The voxels on which to count
+    thresholds: list of floats
+        The thresholds on the values of the maps
+    tails: list of strings
+        Among 'absolute', 'positive' (values > threshold) and 'negative'
+        (values < -threshold)
+    """
+
+    def __init__(self, mask, thresholds=(3, ), tails=('absolute', )):
+        for tail in tails:
+            if not tail in TAILS:
+                raise ValueError('Unknown tail %r, should be one of %s'
+                                 % (tail, TAILS))
+        self.mask = np.asarray(mask, dtype=np.bool)
+        self.thresholds = np.asarray(thresholds, dtype=np.float)
+        self.tails = tuple(tails)
+        self.counts = dict()
+        self.n_images = dict()
+
+    def _counts(self, map_type):
+        if not map_type in self.counts:
+            self.counts[map_type] = np.zeros((len(self.tails),
+                                              len(self.thresholds),
+                                              self.mask.sum()),
+                                             dtype=np.int32)
+            self.n_images[map_type] = 0
+        return self.counts[map_type]
+
+    def add(self, data, map_type=None):
+        """ Add a 3D or 4D map in the space of the mask """
+        # Masking gives a (n_voxels, n_volumes) array
+        values = np.asarray(data)[self.mask].reshape((self.mask.sum(), -1))
+        values = np.nan_to_num(values)
+        map_types = ['all']
+        if map_type is not None:
+            map_types.append(map_type)
+        for tail_idx, tail in enumerate(self.tails):
+            if tail == 'absolute':
+                tail_values = np.abs(values)
+            elif tail == 'positive':
+                tail_values = values
+            else:
+                tail_values = -values
+            for thr_idx, threshold in enumerate(self.thresholds):
+                count = (tail_values > threshold).sum(axis=1)
+                for this_type in map_types:
+                    self._counts(this_type)[tail_idx, thr_idx] += count
+        for this_type in map_types:
+            self._counts(this_type)
+            self.n_images[this_type] += values.shape[1]
+        return self
+
+    def merge(self, other):
+        """ Add the counts of another accumulator, eg computed in parallel
+        on another batch of maps
+        """
+        if (self.tails != other.tails
+                or not np.all(self.thresholds == other.thresholds)):
+            raise ValueError('Cannot merge accumulators with different '
+                             'thresholds or tails')
+        for map_type, counts in other.counts.items():
+            self._counts(map_type)
+            self.counts[map_type] += counts
+            self.n_images[map_type] += other.n_images[map_type]
+        return self
+
+    def get_maps(self, affine):
+        """ The maps of frequency of activation, in percent of the maps,
+        as a dictionary of Nifti1Images indexed by (map_type, tail,
+        threshold)
+        """
+        maps = dict()
+        for map_type, counts in self.counts.items():
+            n_images = max(self.n_images[map_type], 1)
+            for tail_idx, tail in enumerate(self.tails):
+                for thr_idx, threshold in enumerate(self.thresholds):
+                    data = np.zeros(self.mask.shape, dtype=np.float32)
+                    data[self.mask] = (counts[tail_idx, thr_idx]
+                                       * (100. / n_images))
+                    maps[(map_type, tail, threshold)] = nb.Nifti1Image(
+                        data, affine)
+        return maps
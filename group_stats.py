@@ -0,0 +1,126 @@
+""" Mean and t-statistic maps for many groups of images at once, from
+sufficient statistics (counts, sums, sums of squares) accumulated in a
+single pass over the data matrix.
+"""
+# License: BSD
+
+import numpy as np
+from sklearn.utils import check_random_state
+
+
+def sufficient_statistics(X, groups, chunk_size=500):
+    """ Counts, sums and sums of squares of the rows of X in each group,
+    and of all the rows
+
+    Parameters
+    ----------
+    X: array, (n_images, n_voxels)
+        The data, read in chunks of chunk_size rows (it can be a memmap)
+    groups: array, (n_images, n_groups)
+        Non-zero where an image belongs to a group
+
+    Returns
+    -------
+    counts: array, (n_groups, )
+    sums, squares: arrays, (n_groups, n_voxels)
+    total_sum, total_squares: arrays, (n_voxels, )
+    """
+    groups = (np.asarray(groups) != 0).astype(np.float)
+    n_images, n_voxels = X.shape
+    counts = groups.sum(axis=0)
+    sums = np.zeros((groups.shape[1], n_voxels))
+    squares = np.zeros((groups.shape[1], n_voxels))
+    total_sum = np.zeros(n_voxels)
+    total_squares = np.zeros(n_voxels)
+    for start in range(0, n_images, chunk_size):
+        chunk = np.array(X[start:start + chunk_size], dtype=np.float)
+        these_groups = groups[start:start + chunk_size].T
+        sums += np.dot(these_groups, chunk)
+        total_sum += chunk.sum(axis=0)
+        chunk **= 2
+        squares += np.dot(these_groups, chunk)
+        total_squares += chunk.sum(axis=0)
+    return counts, sums, squares, total_sum, total_squares
+
+
+def _t_statistics(n_images, counts, sums, squares, total_sum,
+                  total_squares, equal_var=True):
+    """ The means of the groups, and the t statistics of each group
+    versus the other images
+    """
+    n1 = counts[:, np.newaxis]
+    n2 = n_images - n1
+    sums2 = total_sum - sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = sums / n1
+        mean2 = sums2 / n2
+        # Sums of squared deviations to the mean
+        ss1 = squares - sums * mean1
+        ss2 = total_squares - squares - sums2 * mean2
+        if equal_var:
+            var = (ss1 + ss2) / (n_images - 2)
+            t = (mean1 - mean2) / np.sqrt(var * (1. / n1 + 1. / n2))
+        else:
+            # Welch's t test
+            t = (mean1 - mean2) / np.sqrt(ss1 / ((n1 - 1) * n1)
+                                          + ss2 / ((n2 - 1) * n2))
+    return mean1, t
+
+
+def group_t_maps(X, groups, equal_var=True, chunk_size=500):
+    """ For each group, the mean of its images, and the t statistic of
+    its images versus the other images (Student's t test as
+    scipy.stats.ttest_ind, or Welch's t test if equal_var is False)
+
+    Returns
+    -------
+    means, t: arrays, (n_groups, n_voxels)
+    """
+    return _t_statistics(X.shape[0],
+                         *sufficient_statistics(X, groups,
+                                                chunk_size=chunk_size),
+                         equal_var=equal_var)
+
+
+def permutation_thresholds(X, groups, n_permutations=1000, alpha=.05,
+                           equal_var=True, batch_size=10, block_size=5000,
+                           random_state=0):
+    """ Thresholds on the absolute t statistics of each group controlling
+    the family-wise error rate at alpha, by permutation of the images
+    (max statistic)
+
+    X is read once, by blocks of block_size voxels (columns). For each
+    block, the t statistics of all the permutations are computed,
+    batch_size permutations at a time, and the maximum over the voxels of
+    the block is kept. Accumulating the sums of all the permutations over
+    chunks of rows instead would hold n_permutations * n_groups maps in
+    memory.
+
+    Returns
+    -------
+    thresholds: array, (n_groups, )
+    """
+    rng = check_random_state(random_state)
+    groups = np.asarray(groups) != 0
+    n_images, n_groups = groups.shape
+    # The same permutations for all the blocks
+    permutations = np.array([rng.permutation(n_images)
+                             for _ in range(n_permutations)])
+    max_t = np.zeros((n_permutations, n_groups))
+    for start in range(0, X.shape[1], block_size):
+        block = np.array(X[:, start:start + block_size], dtype=np.float)
+        for batch in range(0, n_permutations, batch_size):
+            these_permutations = permutations[batch:batch + batch_size]
+            # Stack the permuted groups of the batch side by side
+            permuted = np.hstack([groups[permutation]
+                                  for permutation in these_permutations])
+            _, t = _t_statistics(n_images,
+                                 *sufficient_statistics(
+                                        block, permuted,
+                                        chunk_size=max(n_images, 1)),
+                                 equal_var=equal_var)
+            t = np.nan_to_num(np.abs(t)).max(axis=1)
+            t = t.reshape((len(these_permutations), n_groups))
+            max_t[batch:batch + len(t)] = np.maximum(
+                                    max_t[batch:batch + len(t)], t)
+    return np.percentile(max_t, 100 * (1 - alpha), axis=0)
@@ -0,0 +1,171 @@
+""" Instrumentation of the pipeline: per-image timings of each stage,
+counters (bytes transferred, cache hits and misses), errors by category,
+and live progress with throughput and ETA.
+
+A RunReport is passed to the stages, that record in it, and is saved as
+a JSON run report at the end:
+
+    report = RunReport()
+    images_df = download_and_resample(images_df, dest_dir, target,
+                                      report=report)
+    report.save('run_report.json')
+"""
+# License: BSD
+
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from fileutils import write_json
+
+
+def error_category(error):
+    """ The category of an exception, eg 'HTTPError 404' or 'URLError' """
+    category = type(error).__name__
+    code = getattr(error, 'code', None)
+    if code is not None:
+        category = '%s %s' % (category, code)
+    return category
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%i:%02i:%02i' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+class Progress(object):
+    """ Count the items processed by a stage, printing the throughput and
+    the ETA every interval seconds (never if interval is None)
+    """
+
+    def __init__(self, stage, total, interval=10.):
+        self.stage = stage
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self._last_print = self.start
+        self._lock = threading.Lock()
+
+    def step(self, n=1):
+        with self._lock:
+            self.done += n
+            now = time.time()
+            if self.interval is None or (now - self._last_print
+                                         < self.interval
+                                         and self.done < self.total):
+                return
+            self._last_print = now
+            elapsed = now - self.start
+            rate = self.done / elapsed if elapsed else 0
+            eta = (self.total - self.done) / rate if rate else 0
+            print '[%s] %i/%i (%.1f%%), %.2f images/s, ETA %s' % (
+                self.stage, self.done, self.total,
+                100. * self.done / max(self.total, 1), rate,
+                _format_duration(eta))
+            sys.stdout.flush()
+
+
+class RunReport(object):
+    """ The record of a run of the pipeline
+
+    Thread safe: the stages record in it from their download threads.
+    Work done in worker processes is timed there, and recorded by the
+    parent.
+
+    Parameters
+    ----------
+    progress_interval: float or None
+        The interval, in seconds, between the progress lines printed. If
+        None, the progress is not printed.
+    """
+
+    def __init__(self, progress_interval=10.):
+        self.progress_interval = progress_interval
+        self.start = time.time()
+        # stage -> list of (image_id, seconds)
+        self.timings = dict()
+        self.counters = dict()
+        self.errors = list()
+        self._lock = threading.Lock()
+
+    def record(self, stage, image_id, seconds):
+        """ Record the wall time of a stage for an image """
+        if hasattr(image_id, 'item'):
+            image_id = image_id.item()
+        with self._lock:
+            self.timings.setdefault(stage, list()).append((image_id,
+                                                           seconds))
+
+    @contextmanager
+    def timer(self, stage, image_id):
+        """ Time the enclosed block, as the stage of the image """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, image_id, time.time() - t0)
+
+    def count(self, name, value=1):
+        """ Increment a counter, eg 'download.bytes' """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def error(self, stage, image_id, error, message=None):
+        """ Record an error, given as an exception, or as its category
+        (see error_category) and message
+        """
+        if isinstance(error, BaseException):
+            error, message = error_category(error), str(error)
+        if hasattr(image_id, 'item'):
+            image_id = image_id.item()
+        with self._lock:
+            self.errors.append(dict(stage=stage, image_id=image_id,
+                                    category=error, message=message))
+
+    def progress(self, stage, total):
+        """ A Progress for the given number of items of a stage """
+        return Progress(stage, total, interval=self.progress_interval)
+
+    def summary(self):
+        """ The report, as a dictionary that can be saved in JSON """
+        stages = dict()
+        for stage, timings in self.timings.items():
+            seconds = np.array([t[1] for t in timings])
+            slowest = np.argsort(seconds)[::-1][:10]
+            stages[stage] = dict(n_images=len(timings),
+                                 total=float(seconds.sum()),
+                                 mean=float(seconds.mean()),
+                                 median=float(np.median(seconds)),
+                                 max=float(seconds.max()),
+                                 slowest=[timings[idx] for idx in slowest])
+        error_counts = dict()
+        for error in self.errors:
+            key = '%s: %s' % (error['stage'], error['category'])
+            error_counts[key] = error_counts.get(key, 0) + 1
+        return dict(start=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                        time.localtime(self.start)),
+                    wall_time=time.time() - self.start,
+                    stages=stages, counters=self.counters,
+                    error_counts=error_counts, errors=self.errors,
+                    timings=self.timings)
+
+    def save(self, filename):
+        """ Save the report as JSON """
+        write_json(filename, self.summary())
+
+    def print_summary(self):
+        summary = self.summary()
+        print 'Run time: %s' % _format_duration(summary['wall_time'])
+        for stage, stats in sorted(summary['stages'].items()):
+            print '%-16s %6i images, total %s, mean %.2fs, max %.2fs' % (
+                stage, stats['n_images'], _format_duration(stats['total']),
+                stats['mean'], stats['max'])
+        for name, value in sorted(summary['counters'].items()):
+            print '%-32s %i' % (name, value)
+        for key, count in sorted(summary['error_counts'].items()):
+            print 'Errors in %-32s %i' % (key, count)
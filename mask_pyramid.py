@@ -0,0 +1,160 @@
+""" A pyramid of grey matter masks at several resolutions (2mm, 3mm and
+4mm), with the maps between the voxels of its levels.
+
+The grid of a coarser level has the same orientation and origin as the
+grid of the mask, with larger voxels. A coarse voxel is in the coarse
+mask if at least half of the fine voxels that it contains are in the
+mask. The mask image of a level also defines its target space, for the
+resampling.
+
+For each pair of levels, an index gives, for each voxel of the finer
+mask, the voxel of the coarser mask that contains it (-1 if that voxel
+is not in the coarser mask), in the order of the masked data
+(data[mask]). Data masked at one level can then be moved to another
+without resampling (see downsample and upsample): analyses can run on
+the 4mm data, and their results be brought back to 2mm.
+
+The masks are saved next to the mask, as 'gm_mask_3mm.nii.gz' and
+'gm_mask_4mm.nii.gz' for 'gm_mask.nii.gz', and the indices in
+'gm_mask_pyramid.npz'.
+"""
+# License: BSD
+
+import os
+
+import numpy as np
+from scipy import sparse as sp
+from scipy import linalg
+import nibabel as nb
+
+from nipype.utils.filemanip import split_filename
+
+# The voxel sizes of the levels, in mm
+LEVELS = (2, 3, 4)
+
+
+def voxel_size(affine):
+    return np.abs(linalg.det(np.asarray(affine)[:3, :3])) ** (1. / 3)
+
+
+def level_filename(mask_img, level):
+    """ The file of the mask of a level of the pyramid of mask_img (the
+    mask itself at its own voxel size)
+    """
+    if np.allclose(level, voxel_size(nb.load(mask_img).get_affine())):
+        return mask_img
+    path, base, ext = split_filename(mask_img)
+    return os.path.join(path, '%s_%imm%s' % (base, level, ext))
+
+
+def pyramid_filename(mask_img):
+    path, base, _ = split_filename(mask_img)
+    return os.path.join(path, '%s_pyramid.npz' % base)
+
+
+def _nearest(coords):
+    """ The nearest integers, with halves rounded up: np.round rounds them
+    to even, which gives coarse voxels of very uneven sizes
+    """
+    # The tolerance keeps the halves computed through the affines (in
+    # level_index) on the same side as the exact ones
+    return np.floor(np.asarray(coords) + .5 + 1e-6).astype(np.int)
+
+
+def coarsen_mask(mask_nii, level, threshold=.5):
+    """ The mask on the grid of the given voxel size (mm) with the
+    orientation and the origin of the grid of mask_nii
+    """
+    affine = mask_nii.get_affine()
+    mask = mask_nii.get_data().astype(np.bool)
+    scale = level / voxel_size(affine)
+    coarse_affine = affine.copy()
+    coarse_affine[:3, :3] *= scale
+    coarse_shape = tuple(int(_nearest((n - 1) / scale)) + 1
+                         for n in mask.shape[:3])
+    # The coarse voxel containing each fine voxel
+    coarse_ijk = _nearest(np.indices(mask.shape[:3]).reshape((3, -1))
+                          / scale)
+    coarse_voxels = np.ravel_multi_index(coarse_ijk, coarse_shape)
+    n_coarse = int(np.prod(coarse_shape))
+    n_in_mask = np.bincount(coarse_voxels, weights=mask.ravel(),
+                            minlength=n_coarse)
+    n_fine = np.bincount(coarse_voxels, minlength=n_coarse)
+    fraction = n_in_mask / np.maximum(n_fine, 1)
+    coarse_mask = (fraction >= threshold).reshape(coarse_shape)
+    return nb.Nifti1Image(coarse_mask.astype(np.uint8), coarse_affine)
+
+
+def level_index(fine_nii, coarse_nii):
+    """ For each voxel of the fine mask, the index of the voxel of the
+    coarse mask containing it, -1 if it is not in the coarse mask
+    """
+    fine_mask = fine_nii.get_data().astype(np.bool)
+    coarse_mask = coarse_nii.get_data().astype(np.bool)
+    # Fine voxels -> world -> coarse voxels
+    transform = np.dot(linalg.inv(coarse_nii.get_affine()),
+                       fine_nii.get_affine())
+    coarse_ijk = _nearest(np.dot(transform[:3, :3], np.array(
+                                np.where(fine_mask))) + transform[:3, 3:])
+    inside = np.all((coarse_ijk >= 0) & (coarse_ijk < np.array(
+                        coarse_mask.shape)[:, np.newaxis]), axis=0)
+    ranks = -np.ones(coarse_mask.shape, dtype=np.int64)
+    ranks[coarse_mask] = np.arange(coarse_mask.sum())
+    index = -np.ones(fine_mask.sum(), dtype=np.int64)
+    index[inside] = ranks[tuple(coarse_ijk[:, inside])]
+    return index
+
+
+def build_pyramid(mask_img, levels=LEVELS, threshold=.5):
+    """ Save the masks of the levels of the pyramid of mask_img, and the
+    indices between their voxels
+    """
+    mask_nii = nb.load(mask_img)
+    niimgs = dict()
+    for level in levels:
+        filename = level_filename(mask_img, level)
+        if filename == mask_img:
+            niimgs[level] = mask_nii
+            continue
+        niimgs[level] = coarsen_mask(mask_nii, level, threshold=threshold)
+        niimgs[level].to_filename(filename)
+    indices = dict()
+    for fine in levels:
+        for coarse in levels:
+            if coarse > fine:
+                indices['index_%i_%i' % (fine, coarse)] = level_index(
+                                        niimgs[fine], niimgs[coarse])
+    np.savez(pyramid_filename(mask_img), **indices)
+
+
+def load_index(mask_img, fine, coarse):
+    """ The index from the voxels of the fine level to those of the
+    coarse level of the pyramid of mask_img
+    """
+    with np.load(pyramid_filename(mask_img)) as npz:
+        return npz['index_%i_%i' % (fine, coarse)]
+
+
+def downsample(X, index, n_coarse):
+    """ Average the columns of the masked data X, at a fine level, in the
+    n_coarse voxels of a coarse level, given the index between the levels
+    """
+    valid = index >= 0
+    counts = np.bincount(index[valid], minlength=n_coarse).astype(np.float)
+    counts[counts == 0] = 1
+    average = sp.csr_matrix((1. / counts[index[valid]],
+                             (np.where(valid)[0], index[valid])),
+                            shape=(len(index), n_coarse))
+    return np.asarray(average.T.dot(np.asarray(X, dtype=np.float32).T).T,
+                      dtype=np.float32)
+
+
+def upsample(X, index):
+    """ The masked data X, at a coarse level, on the voxels of a fine
+    level, given the index between the levels (0 out of the coarse mask)
+    """
+    X = np.atleast_2d(X)
+    out = np.zeros((len(X), len(index)), dtype=np.float32)
+    valid = index >= 0
+    out[:, valid] = X[:, index[valid]]
+    return out
@@ -0,0 +1,282 @@
+""" NeuroSynth meta-analyses of many terms at once, on a cached sparse
+matrix of the activations of the studies.
+
+The activations of the studies of a NeuroSynth dataset are extracted
+once, as a sparse (n_studies, n_voxels) matrix, and cached on disk with
+the selection of the studies of each term (feature) and the grid of the
+voxels. The meta-analyses of a batch of terms are then sparse matrix
+products of the selections of the terms with the activations, and their
+FDR thresholds are computed for all the terms at once. Batches of terms
+are run in parallel.
+
+The maps are those of neurosynth.analysis.meta.MetaAnalysis:
+
+* 'pA': the probability of activation
+* 'pAgF', 'pFgA': the probabilities of activation given the term, and
+  of the term given activation
+* 'pAgF_given_pF=0.50', 'pFgA_given_pF=0.50': the same, for a prior
+  probability of the term (here .5)
+* 'pAgF_z', 'pFgA_z': the z scores of the forward (one-way chi-square)
+  and of the reverse (two-way chi-square) inference tests
+* 'pAgF_z_FDR_0.01', 'pFgA_z_FDR_0.01': the same, thresholded with an
+  FDR (here .01)
+"""
+# License: BSD
+
+from collections import namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse as sp
+from scipy import special, stats
+import nibabel as nb
+
+StudyCache = namedtuple('StudyCache', ('activations', 'features',
+                                       'feature_selection', 'study_ids',
+                                       'index_volume', 'affine'))
+
+
+def _save_sparse(arrays, prefix, X):
+    X = sp.csr_matrix(X)
+    arrays.update({prefix + '_data': X.data, prefix + '_indices': X.indices,
+                   prefix + '_indptr': X.indptr, prefix + '_shape': X.shape})
+
+
+def _load_sparse(npz, prefix):
+    return sp.csr_matrix((npz[prefix + '_data'], npz[prefix + '_indices'],
+                          npz[prefix + '_indptr']),
+                         shape=tuple(npz[prefix + '_shape']))
+
+
+def build_study_cache(dataset, filename, frequency_threshold=.001):
+    """ Save the activations of the studies of a NeuroSynth dataset, and
+    the studies of each of its features, in the .npz file filename
+
+    A study is selected for a feature if the frequency of the feature in
+    the study is above frequency_threshold.
+    """
+    activations = sp.csr_matrix(dataset.image_table.data.T != 0,
+                                dtype=np.uint8)
+    study_ids = [str(study_id) for study_id in dataset.image_table.ids]
+    rows = dict((study_id, row) for row, study_id in enumerate(study_ids))
+    features = list(dataset.get_feature_names())
+    selection_rows = list()
+    selection_cols = list()
+    for idx, feature in enumerate(features):
+        these_rows = [rows[str(study_id)] for study_id in
+                      dataset.get_ids_by_features(
+                          feature, threshold=frequency_threshold)
+                      if str(study_id) in rows]
+        selection_rows.extend([idx] * len(these_rows))
+        selection_cols.extend(these_rows)
+    feature_selection = sp.csr_matrix(
+        (np.ones(len(selection_rows), dtype=np.uint8),
+         (selection_rows, selection_cols)),
+        shape=(len(features), len(study_ids)))
+    # The column of each voxel of the grid (0 out of the mask of the
+    # dataset), whatever the conventions of its masker
+    n_voxels = activations.shape[1]
+    volume = dataset.masker.volume
+    index_volume = np.asarray(dataset.masker.unmask(
+                                        np.arange(1, n_voxels + 1)))
+    index_volume = index_volume.reshape(volume.shape[:3])
+
+    arrays = dict(features=np.array(features, dtype=np.unicode_),
+                  study_ids=np.array(study_ids, dtype=np.unicode_),
+                  index_volume=index_volume.astype(np.int32),
+                  affine=volume.get_affine())
+    _save_sparse(arrays, 'activations', activations)
+    _save_sparse(arrays, 'feature_selection', feature_selection)
+    np.savez(filename, **arrays)
+
+
+def load_study_cache(filename):
+    """ Load the study cache. The activations are converted to float32,
+    as their counts would overflow uint8.
+    """
+    with np.load(filename) as npz:
+        return StudyCache(activations=_load_sparse(
+                                npz, 'activations').astype(np.float32),
+                          features=list(npz['features']),
+                          feature_selection=_load_sparse(
+                                            npz, 'feature_selection'),
+                          study_ids=list(npz['study_ids']),
+                          index_volume=npz['index_volume'],
+                          affine=npz['affine'])
+
+
+def select_terms(cache, terms):
+    """ The sparse (n_terms, n_studies) matrix of the studies of each
+    term
+    """
+    rows = dict((feature, row) for row, feature in enumerate(cache.features))
+    missing = [term for term in terms if not term in rows]
+    if missing:
+        raise KeyError('Terms %s are not features of the dataset' % missing)
+    return cache.feature_selection[[rows[term] for term in terms]].astype(
+                                                                np.float32)
+
+
+def to_niimg(values, cache):
+    """ The image of a map given on the voxels of the dataset """
+    index_volume = cache.index_volume
+    data = np.zeros(index_volume.shape, dtype=np.float32)
+    in_mask = index_volume > 0
+    data[in_mask] = values[index_volume[in_mask] - 1]
+    return nb.Nifti1Image(data, cache.affine)
+
+
+def activation_frequency(activations):
+    """ The probability of activation of each voxel, over the studies """
+    return (np.asarray(activations.sum(axis=0), dtype=np.float).ravel()
+            / activations.shape[0])
+
+
+def fdr_thresholds(p, q=.01):
+    """ The Benjamini-Hochberg thresholds of the rows of p values, -1 for
+    the rows where no value survives
+    """
+    n = p.shape[1]
+    p_sorted = np.sort(p, axis=1)
+    below = p_sorted <= q * np.arange(1, n + 1) / float(n)
+    # The last sorted p value below the line, in each row
+    last = n - 1 - np.argmax(below[:, ::-1], axis=1)
+    return np.where(below.any(axis=1),
+                    p_sorted[np.arange(len(p)), last], -1)
+
+
+def _p_to_z(p, sign):
+    # Clip the p values, so that the z scores are finite
+    p = np.clip(p, 1e-240, 1)
+    return np.abs(stats.norm.isf(p / 2)) * sign
+
+
+def meta_analysis(activations, selection, images=('pFgA_z_FDR_0.01', ),
+                  prior=.5):
+    """ The maps of the meta-analyses of several terms
+
+    Parameters
+    ----------
+    activations: sparse matrix, (n_studies, n_voxels)
+        The activations of the studies
+    selection: sparse matrix, (n_terms, n_studies)
+        The studies of each term
+    images: list of strings
+        The maps to compute (see the module docstring). The FDR of a
+        thresholded map is given by its name.
+    prior: float
+        The prior probability of the terms, for the '_given_pF' maps
+
+    Returns
+    -------
+    A dictionary of (n_terms, n_voxels) float32 arrays, indexed by the
+    names of the maps
+    """
+    n_studies = float(activations.shape[0])
+    total = np.asarray(activations.sum(axis=0), dtype=np.float).ravel()
+    n_sel = np.asarray(selection.sum(axis=1), dtype=np.float)
+    n_unsel = n_studies - n_sel
+    # The number of studies activating each voxel, with and without the
+    # term
+    sel = np.asarray(selection.dot(activations).todense(), dtype=np.float)
+    unsel = total - sel
+
+    maps = dict()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pA = total / n_studies
+        pAgF = sel / n_sel
+        pAgU = unsel / n_unsel
+        maps['pA'] = np.tile(pA, (len(sel), 1))
+        maps['pAgF'] = pAgF
+        maps['pFgA'] = pAgF * (n_sel / n_studies) / pA
+        pAgF_prior = prior * pAgF + (1 - prior) * pAgU
+        maps['pAgF_given_pF=%0.2f' % prior] = pAgF_prior
+        maps['pFgA_given_pF=%0.2f' % prior] = pAgF * prior / pAgF_prior
+
+        p_values = dict()
+        if any(name.startswith('pAgF_z') for name in images):
+            # One-way chi-square test: activation with the term compared
+            # to the mean over the voxels
+            expected = sel.mean(axis=1)[:, np.newaxis]
+            chi2 = ((sel - expected) ** 2 / expected
+                    + (sel - expected) ** 2 / (n_sel - expected))
+            # Undefined tests (eg terms without studies) are not
+            # significant
+            p_values['pAgF_z'] = np.where(np.isnan(chi2), 1,
+                                          special.chdtrc(1, chi2))
+            maps['pAgF_z'] = _p_to_z(p_values['pAgF_z'],
+                                     np.sign(sel - expected))
+        if any(name.startswith('pFgA_z') for name in images):
+            # Two-way chi-square test of the independence of activation
+            # and term
+            chi2 = 0
+            for observed, row_total, col_total in [
+                    (sel, total, n_sel),
+                    (unsel, total, n_unsel),
+                    (n_sel - sel, n_studies - total, n_sel),
+                    (n_unsel - unsel, n_studies - total, n_unsel)]:
+                expected = row_total * col_total / n_studies
+                chi2 = chi2 + (observed - expected) ** 2 / expected
+            p_values['pFgA_z'] = np.where(np.isnan(chi2), 1,
+                                          special.chdtrc(1, chi2))
+            maps['pFgA_z'] = _p_to_z(p_values['pFgA_z'],
+                                     np.sign(pAgF - pAgU))
+
+    out = dict()
+    for name in images:
+        if '_FDR_' in name:
+            z_name, q = name.split('_FDR_')
+            p = p_values[z_name]
+            thresholds = fdr_thresholds(p, q=float(q))
+            values = maps[z_name] * (p <= thresholds[:, np.newaxis])
+        else:
+            values = maps[name]
+        out[name] = np.nan_to_num(values).astype(np.float32)
+    return out
+
+
+# The cache, in the worker processes
+_CACHE = None
+
+
+def _load_worker_cache(filename):
+    global _CACHE
+    _CACHE = load_study_cache(filename)
+
+
+def _meta_analysis_batch(terms, images, prior):
+    return meta_analysis(_CACHE.activations, select_terms(_CACHE, terms),
+                         images=images, prior=prior)
+
+
+def term_meta_analyses(cache_file, terms, images=('pFgA_z_FDR_0.01', ),
+                       prior=.5, batch_size=20, n_jobs=1):
+    """ The maps of the meta-analyses of the terms, computed on the study
+    cache by batches of batch_size terms, by n_jobs processes
+
+    Returns a dictionary of (n_terms, n_voxels) arrays, indexed by the
+    names of the maps (see meta_analysis).
+    """
+    terms = list(terms)
+    batches = [terms[start:start + batch_size]
+               for start in range(0, len(terms), batch_size)]
+    if n_jobs == 1:
+        cache = load_study_cache(cache_file)
+        results = [meta_analysis(cache.activations,
+                                 select_terms(cache, batch),
+                                 images=images, prior=prior)
+                   for batch in batches]
+    else:
+        # Each worker loads the cache once
+        pool = Pool(n_jobs, initializer=_load_worker_cache,
+                    initargs=(cache_file, ))
+        try:
+            results = [result.get() for result in
+                       [pool.apply_async(_meta_analysis_batch,
+                                         (batch, images, prior))
+                        for batch in batches]]
+        finally:
+            pool.terminate()
+    return dict((name, np.concatenate([result[name]
+                                       for result in results]))
+                for name in images)
@@ -0,0 +1,115 @@
+""" A columnar store for the metadata of the images: one file per column,
+so that a script only reads the columns it uses.
+
+The store is a directory with a 'schema.json' file giving, for each
+column, its kind and its file:
+
+* numerical and boolean columns are stored as .npy arrays
+* categorical columns are stored as .npy arrays of integer codes, their
+  categories being in the schema
+* other columns (text) are stored as JSON lists
+
+The store is written in a temporary directory, that replaces the
+previous one once complete: readers never see the columns of a store
+with the schema of another (but can find no store, for the instant of
+the swap), and the files of the dropped columns go with the previous
+store.
+"""
+# License: BSD
+
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from fileutils import mkdir_p, tmp_filename, write_json
+
+# The columns stored as categoricals, if present. The text columns
+# (eg name_collection) are not: they are mapped as strings by the text
+# analysis.
+CATEGORICAL = ('collection_id', 'map_type', 'modality')
+
+
+def _json_default(value):
+    # numpy scalars in object columns
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def save_metadata(metadata, path, categorical=CATEGORICAL):
+    """ Save the metadata DataFrame in the store in the directory path """
+    path = os.path.normpath(path)
+    tmp_path = tmp_filename(path)
+    mkdir_p(tmp_path)
+    schema = dict(columns=list(), index=None)
+    for idx, (name, column) in enumerate(
+            [('__index__', pd.Series(metadata.index))]
+            + list(metadata.iteritems())):
+        entry = dict(name=name)
+        if name in categorical:
+            column = pd.Categorical(column)
+            entry['kind'] = 'categorical'
+            entry['categories'] = [c.item() if hasattr(c, 'item') else c
+                                   for c in column.categories]
+            entry['file'] = 'column_%03d.npy' % idx
+            np.save(os.path.join(tmp_path, entry['file']),
+                    np.asarray(column.codes, dtype=np.int32))
+        elif column.dtype.kind in 'biuf':
+            entry['kind'] = 'array'
+            entry['file'] = 'column_%03d.npy' % idx
+            np.save(os.path.join(tmp_path, entry['file']), column.values)
+        else:
+            entry['kind'] = 'json'
+            entry['file'] = 'column_%03d.json' % idx
+            values = [None if isinstance(v, float) and np.isnan(v) else v
+                      for v in column]
+            with open(os.path.join(tmp_path, entry['file']), 'w') as f:
+                json.dump(values, f, default=_json_default)
+        if name == '__index__':
+            schema['index'] = entry
+        else:
+            schema['columns'].append(entry)
+    write_json(os.path.join(tmp_path, 'schema.json'), schema)
+
+    # Replace the previous store
+    old_path = None
+    if os.path.exists(path):
+        old_path = tmp_path + '.old'
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path)
+
+
+def _load_column(path, entry):
+    filename = os.path.join(path, entry['file'])
+    if entry['kind'] == 'categorical':
+        return pd.Categorical.from_codes(np.load(filename),
+                                         entry['categories'])
+    elif entry['kind'] == 'array':
+        return np.load(filename)
+    with open(filename) as f:
+        # Missing values were saved as None
+        return [np.nan if value is None else value for value in json.load(f)]
+
+
+def load_metadata(path, columns=None):
+    """ Load the metadata as a DataFrame, reading only the given columns
+    (all the columns if None)
+    """
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    entries = dict((entry['name'], entry) for entry in schema['columns'])
+    if columns is None:
+        columns = [entry['name'] for entry in schema['columns']]
+    missing = [name for name in columns if not name in entries]
+    if missing:
+        raise KeyError('Columns %s are not in the metadata store %s'
+                       % (missing, path))
+    return pd.DataFrame(dict((name, _load_column(path, entries[name]))
+                             for name in columns),
+                        index=_load_column(path, schema['index']),
+                        columns=columns)
@@ -0,0 +1,181 @@
+""" A client to decode NeuroVault images with NeuroSynth.
+
+Images are decoded concurrently, under a maximum request rate, with
+retries and exponential backoff on transient errors. Each result is
+cached on disk as it arrives, so that an interrupted job restarts where
+it stopped. Failures are cached too, and retried once they are older
+than a time to live.
+"""
+# License: BSD
+
+import os
+import json
+import time
+import socket
+import httplib
+import threading
+from multiprocessing.pool import ThreadPool
+from urllib2 import Request, urlopen, HTTPError, URLError
+
+import numpy as np
+from scipy import sparse as sp
+
+from instrumentation import RunReport
+from fileutils import mkdir_p, write_json
+
+NEUROSYNTH_DECODE_URL = 'http://neurosynth.org/decode/data/'
+
+
+class DecodingClient(object):
+    """ Decode NeuroVault images with NeuroSynth
+
+    Parameters
+    ----------
+    cache_dir: string
+        The directory where the decodings are cached
+    url: string
+        The url of the NeuroSynth decoding API
+    n_jobs: int
+        The number of concurrent requests
+    max_rate: float
+        The maximum number of requests per second
+    max_retries: int
+        The number of retries on transient errors (network errors,
+        timeouts, broken responses, and server errors)
+    backoff: float
+        The wait before the first retry, in seconds. It doubles at each
+        retry.
+    failure_ttl: float
+        The time, in seconds, during which a failure is cached
+    timeout: float
+        The timeout of the requests, in seconds
+    report: RunReport, optional
+        Where the timings, cache hits and errors are recorded, and the
+        progress reported (see instrumentation)
+    """
+
+    def __init__(self, cache_dir, url=NEUROSYNTH_DECODE_URL, n_jobs=4,
+                 max_rate=4., max_retries=3, backoff=1.,
+                 failure_ttl=24 * 3600., timeout=60., report=None):
+        self.cache_dir = cache_dir
+        self.url = url
+        self.n_jobs = n_jobs
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failure_ttl = failure_ttl
+        self.timeout = timeout
+        if report is None:
+            report = RunReport()
+        self.report = report
+        mkdir_p(cache_dir)
+        self._lock = threading.Lock()
+        self._next_request = 0
+
+    def _wait_rate(self):
+        """ Wait for our turn to send a request, given max_rate """
+        with self._lock:
+            now = time.time()
+            wait = self._next_request - now
+            self._next_request = max(now, self._next_request) \
+                + 1. / self.max_rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def _fetch(self, neurovault_id):
+        url = '%s?neurovault=%s' % (self.url, neurovault_id)
+        for retry in range(self.max_retries + 1):
+            self._wait_rate()
+            try:
+                response = urlopen(Request(url), timeout=self.timeout)
+                try:
+                    body = response.read()
+                finally:
+                    response.close()
+                self.report.count('decoding.bytes', len(body))
+                data = json.loads(body)['data']
+                return dict([(i['analysis'], i['r']) for i in data])
+            except HTTPError as e:
+                # Client errors will not go away
+                if e.code < 500 or retry == self.max_retries:
+                    raise
+            except (URLError, socket.error, httplib.HTTPException):
+                # Also raised while reading the response (eg timeouts,
+                # connection resets, incomplete reads)
+                if retry == self.max_retries:
+                    raise
+            self.report.count('decoding.retries')
+            time.sleep(self.backoff * 2 ** retry)
+
+    def _cache_file(self, neurovault_id):
+        return os.path.join(self.cache_dir, '%s.json' % neurovault_id)
+
+    def decode_image(self, neurovault_id):
+        """ The NeuroSynth terms of an image, as a dictionary of
+        correlations, or None if the decoding failed
+        """
+        cache_file = self._cache_file(neurovault_id)
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                entry = json.load(f)
+            if entry['status'] == 'ok':
+                self.report.count('decoding.cache_hit')
+                return entry['data']
+            if time.time() - entry['time'] < self.failure_ttl:
+                self.report.count('decoding.cached_failure')
+                return None
+
+        print "Fetching terms for image %s" % neurovault_id
+        self.report.count('decoding.cache_miss')
+        try:
+            with self.report.timer('decoding', neurovault_id):
+                entry = dict(status='ok', data=self._fetch(neurovault_id))
+        except (HTTPError, URLError, socket.error, httplib.HTTPException,
+                ValueError, KeyError) as e:
+            print "Could not decode image %s: %s" % (neurovault_id, e)
+            self.report.error('decoding', neurovault_id, e)
+            entry = dict(status='failed', time=time.time(), error=str(e))
+        write_json(cache_file, entry)
+        return entry.get('data')
+
+    def decode(self, neurovault_ids):
+        """ Decode images concurrently: returns a list of dictionaries of
+        correlations (None for failures), in the order of neurovault_ids
+        """
+        # Each image is decoded once, even if it is repeated
+        unique_ids = sorted(set(neurovault_ids))
+        progress = self.report.progress('decoding', len(unique_ids))
+
+        def decode_image(neurovault_id):
+            try:
+                return self.decode_image(neurovault_id)
+            finally:
+                progress.step()
+
+        pool = ThreadPool(self.n_jobs)
+        try:
+            decodings = dict(zip(unique_ids,
+                                 pool.map(decode_image, unique_ids)))
+        finally:
+            pool.terminate()
+        return [decodings[neurovault_id] for neurovault_id in neurovault_ids]
+
+
+def decodings_to_matrix(decodings):
+    """ Turn a list of decodings into a sparse (n_images, n_terms) matrix,
+    failed decodings giving empty rows. Returns the matrix and the terms.
+    """
+    terms = sorted(set(term for decoding in decodings if decoding
+                       for term in decoding))
+    columns = dict((term, col) for col, term in enumerate(terms))
+    rows = list()
+    cols = list()
+    values = list()
+    for row, decoding in enumerate(decodings):
+        for term, value in (decoding or dict()).items():
+            rows.append(row)
+            cols.append(columns[term])
+            values.append(value)
+    X = sp.csr_matrix((np.array(values, dtype=np.float), (rows, cols)),
+                      shape=(len(decodings), len(terms)))
+    return X, terms
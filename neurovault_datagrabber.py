@@ -5,8 +5,16 @@ frequency of activation in the brain.
 # License: BSD
 
 import json
-import urllib, os, errno
-from urllib2 import Request, urlopen, HTTPError
+import sys
+import time
+import os
+import threading
+import socket
+import httplib
+from urllib import urlencode
+from urllib2 import Request, urlopen
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 from pandas.io.json import json_normalize
@@ -16,296 +24,686 @@ import pylab as plt
 from nipype.utils.filemanip import split_filename
 import nibabel as nb
 
-from joblib import Memory
-
 from nilearn.image import resample_img
-from nilearn.masking import compute_background_mask, _extrapolate_out_mask
-from nilearn.plotting.img_plotting import plot_anat
 
-# Use a joblib memory, to avoid depending on an Internet connection
-mem = Memory(cachedir='/tmp/neurovault_analysis/cache')
+from download_store import DownloadStore, Manifest
+from fileutils import mkdir_p
+from extrapolation import preprocess_image
+from resampling import ResamplingPlans
+from frequency_map import FrequencyAccumulator, load_in_target
+from data_matrix import write_data_matrix, iter_volumes
+from neurosynth_client import DecodingClient, decodings_to_matrix
+from term_matrix import save_term_matrix, clip_negative
+from instrumentation import RunReport, error_category
+from figures import Figure, render_figures
+
+NEUROVAULT_API = 'http://neurovault.org/api'
+
+# The timeout (seconds) of the requests to the API
+API_TIMEOUT = 60
+
+# The number of voxels by which masked maps are extrapolated out of the
+# brain before resampling
+EXTRAPOLATION_ITERATIONS = 3
 
+# The formats in which the resampled maps can be saved: uncompressed
+# files are bigger, but much faster to read
+RESAMPLED_FORMATS = ('nii.gz', 'nii')
 
-def mkdir_p(path):
+
+def _get_json(url):
+    request = Request(url)
+    response = urlopen(request, timeout=API_TIMEOUT)
     try:
-        os.makedirs(path)
-    except OSError as exc: # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else: raise
+        return json.loads(response.read())
+    finally:
+        response.close()
+
+
+def iter_api_pages(endpoint, api_url=NEUROVAULT_API, page_size=100,
+                   n_jobs=4, ordering=None):
+    """Iterate over the pages of records of a NeuroVault API listing.
 
+    The first page gives the total number of records, the following
+    pages are then fetched concurrently by at most n_jobs threads (ie
+    n_jobs open connections), and yielded in order, as lists of records.
+    With n_jobs=1, a page is only fetched when the previous one has been
+    consumed, so that stopping the iteration stops the transfer.
 
-def get_collections_df():
+    The ordering of the records (eg '-modify_date') is requested from
+    the API, if given.
+    """
+    url = '%s/%s/?' % (api_url.rstrip('/'), endpoint)
+    params = dict(format='json', limit=page_size)
+    if ordering is not None:
+        params['ordering'] = ordering
+
+    def page_urls(offsets):
+        return [url + urlencode(dict(params, offset=offset))
+                for offset in offsets]
+
+    first_page = _get_json(page_urls([0])[0])
+    if isinstance(first_page, list):
+        # The API did not paginate: we got everything at once
+        yield first_page
+        return
+    yield first_page['results']
+
+    offsets = range(page_size, first_page['count'], page_size)
+    if not offsets:
+        return
+    if n_jobs == 1:
+        for page_url in page_urls(offsets):
+            yield _get_json(page_url)['results']
+        return
+    pool = ThreadPool(min(n_jobs, len(offsets)))
+    try:
+        for page in pool.imap(_get_json, page_urls(offsets)):
+            yield page['results']
+    finally:
+        pool.terminate()
+
+
+def _pages_to_df(pages, since=None):
+    """Build a DataFrame page by page, keeping only the records modified
+    after 'since' (an ISO 8601 date string, or datetime), if given.
+
+    If the records come most recently modified first, the pages stop
+    being read at the first record older than 'since'.
+    """
+    if hasattr(since, 'isoformat'):
+        since = since.isoformat()
+    chunks = list()
+    # Whether the dates seen so far are in decreasing order: the API
+    # may ignore the ordering requested
+    ordered = True
+    last_date = None
+    for records in pages:
+        if since is not None:
+            dates = [r.get('modify_date') or '' for r in records]
+            sequence = ([last_date] if last_date is not None else []) + dates
+            ordered = ordered and all(a >= b for a, b in
+                                      zip(sequence, sequence[1:]))
+            if dates:
+                last_date = dates[-1]
+            records = [r for r, date in zip(records, dates) if date > since]
+        if records:
+            chunks.append(json_normalize(records))
+        if (since is not None and ordered and last_date is not None
+                and last_date <= since):
+            # The following pages are older
+            if hasattr(pages, 'close'):
+                pages.close()
+            break
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
+
+
+def get_collections_df(api_url=NEUROVAULT_API, n_jobs=4, since=None):
     """Downloads metadata about collections/papers stored in NeuroVault and
-    return it as a pandas DataFrame"""
+    return it as a pandas DataFrame
 
-    request = Request('http://neurovault.org/api/collections/?format=json')
-    response = urlopen(request)
-    elevations = response.read()
-    data = json.loads(elevations)
-    collections_df = json_normalize(data)
+    Only the collections modified after 'since' are returned, if given.
+    """
+    collections_df = _pages_to_df(iter_api_pages('collections',
+                                                 api_url=api_url,
+                                                 n_jobs=n_jobs),
+                                  since=since)
     collections_df.rename(columns={'id':'collection_id'}, inplace=True)
     collections_df.set_index("collection_id")
 
     return collections_df
 
 
-def get_images_df():
+def get_images_df(api_url=NEUROVAULT_API, n_jobs=4, since=None):
     """Downloads metadata about images/statistical maps stored in NeuroVault and 
-    return it as a pandas DataFrame"""
+    return it as a pandas DataFrame
 
-    request=Request('http://neurovault.org/api/images/?format=json')
-    response = urlopen(request)
-    elevations = response.read()
-    data = json.loads(elevations)
-    images_df = json_normalize(data)
+    Only the images modified after 'since' are returned, if given.
+    """
+    if since is None:
+        pages = iter_api_pages('images', api_url=api_url, n_jobs=n_jobs)
+    else:
+        # Most recent first, page by page, to stop at 'since'
+        pages = iter_api_pages('images', api_url=api_url, n_jobs=1,
+                               ordering='-modify_date')
+    images_df = _pages_to_df(pages, since=since)
+    if not len(images_df):
+        return images_df
     images_df['collection'] = images_df['collection'].apply(lambda x: int(x.split("/")[-2]))
     images_df['image_id'] = images_df['url'].apply(lambda x: int(x.split("/")[-2]))
     images_df.rename(columns={'collection':'collection_id'}, inplace=True)
     return images_df
 
 
-def get_images_with_collections_df():
+def get_images_with_collections_df(api_url=NEUROVAULT_API, n_jobs=4,
+                                   since=None):
     """Downloads metadata about images/statistical maps stored in NeuroVault and
     and enriches it with metadata of the corresponding collections. The result 
-    is returned as a pandas DataFrame"""
+    is returned as a pandas DataFrame
+
+    If 'since' is given, only the images modified after it are returned
+    (but they are enriched with all the collections).
+    """
     
-    collections_df = get_collections_df()
-    images_df = get_images_df()
+    collections_df = get_collections_df(api_url=api_url, n_jobs=n_jobs)
+    images_df = get_images_df(api_url=api_url, n_jobs=n_jobs, since=since)
+    if not len(images_df):
+        return images_df
 
     combined_df = pd.merge(images_df, collections_df, how='left', on='collection_id',
                       suffixes=('_image', '_collection'))
     return combined_df
 
 
-def download_and_resample(images_df, dest_dir, target):
-    """Downloads all stat maps and resamples them to a common space.
+def _download(image_id, url, store):
+    """Fetch the file of an image in the download store, and return its
+    name (None on failure, recorded in the report of the store).
+    """
+    _, _, ext = split_filename(url)
+    try:
+        with store.report.timer('download', image_id):
+            return store.fetch(image_id, url, "%04d%s" % (image_id, ext))
+    except (IOError, socket.error, httplib.HTTPException) as e:
+        print "Could not download %s " % url
+        print e
+        store.report.error('download', image_id, e)
+        return None
+
+
+def _volume_ids(image_id, n_volumes):
+    """The image_ids given to the volumes of an image: negative, and
+    without collisions between images (up to 10000 volumes)"""
+    if n_volumes == 1:
+        return [image_id]
+    return [-(image_id * 10000 + index) for index in range(n_volumes)]
+
+
+def _extrapolate_and_resample(image_id, orig_file, sha1, extrapolated_path,
+                              resampled_path, ext, target_affine,
+                              target_shape):
+    """Extrapolate a stat map out of its mask and resample it to the
+    target space, saving it with the extension ext. Returns the list of
+    image_ids of the volumes written (one for a 3D image, one per volume
+    for a 4D image, none on failure), the time spent in each stage, and
+    the category and message of the error, if any.
+    """
+    # This runs in worker processes: the timings and the error are
+    # returned to be recorded by the parent
+    timings = dict()
+    try:
+        # Compute the background and extrapolate outside of the mask, if
+        # the image has been masked (the decision is cached)
+        t0 = time.time()
+        niimg = preprocess_image(image_id, orig_file, sha1,
+                                 extrapolated_path,
+                                 iterations=EXTRAPOLATION_ITERATIONS)
+        timings['extrapolation'] = time.time() - t0
+        # Resampling the file to target and saving the output in the "resampled"
+        # folder
+        resampled_file = os.path.join(resampled_path,
+                                    "%06d%s" % (image_id, ext))
+
+        print "Resampling %s" % orig_file
+        t0 = time.time()
+        resampled_nii = resample_img(niimg, target_affine, target_shape)
+        resampled_nii = nb.Nifti1Image(resampled_nii.get_data().squeeze(),
+                                    resampled_nii.get_affine(),
+                                    header=niimg.get_header())
+        # A 4D image is kept in a single file, its volumes getting one
+        # image_id each
+        resampled_nii.to_filename(resampled_file)
+        timings['resampling'] = time.time() - t0
+        return (_volume_ids(image_id, int(np.prod(resampled_nii.shape[3:]))),
+                timings, None)
+    except Exception as e:
+        # Any error is returned: in a worker process, an exception would
+        # leave the parent waiting for the image
+        print "Could not process %s " % orig_file
+        print e
+        return [], timings, (error_category(e), str(e))
+
+
+def _expand_rows(images_df, out_ids):
+    """Build the output dataframe in one go, given the list of output
+    image_ids for each row: 4D images are replaced by one row per
+    volume, failed images are dropped.
+
+    The NeuroVault id of the image of each row is kept in the
+    'source_image_id' column, and the index of the volume in the image
+    in the 'volume' column.
     """
+    positions = list()
+    image_ids = list()
+    volumes = list()
+    for position, these_ids in enumerate(out_ids):
+        positions.extend([position] * len(these_ids))
+        image_ids.extend(these_ids)
+        volumes.extend(range(len(these_ids)))
+    out_df = images_df.iloc[positions].copy()
+    out_df['source_image_id'] = out_df['image_id']
+    out_df['image_id'] = image_ids
+    out_df['volume'] = volumes
+    return out_df
 
-    target_nii = nb.load(target)
-    orig_path = os.path.join(dest_dir, "original")
-    mkdir_p(orig_path)
-    resampled_path = os.path.join(dest_dir, "resampled")
-    mkdir_p(resampled_path)
-    out_df = combined_df.copy()
 
-    for row in combined_df.iterrows():
-        # Downloading the file to the "original" subfolder
-        _, _, ext = split_filename(row[1]['file'])
-        orig_file = os.path.join(orig_path, "%04d%s" % (row[1]['image_id'], ext))
-        if not os.path.exists(orig_file):
-            print "Downloading %s" % orig_file
-            urllib.urlretrieve(row[1]['file'], orig_file)
+def download_images(images_df, dest_dir, n_jobs=4, report=None):
+    """Download the stat maps in the download store, with n_jobs
+    threads, without processing them. Returns the dataframe of the images
+    that are in the store.
+    """
+    if report is None:
+        report = RunReport()
+    store = DownloadStore(os.path.join(dest_dir, "original"), report=report)
+    progress = report.progress('download', len(images_df))
 
+    def download(row):
         try:
-            # Compute the background and extrapolate outside of the mask
-            print "Extrapolating %s" % orig_file
-            niimg = nb.load(orig_file)
-            data = niimg.get_data().squeeze()
-            niimg = nb.Nifti1Image(data, niimg.affine,
-                                header=niimg.get_header())
-            bg_mask = compute_background_mask(niimg).get_data()
-            # Test if the image has been masked:
-            out_of_mask = data[np.logical_not(bg_mask)]
-            if np.all(np.isnan(out_of_mask)) or len(np.unique(out_of_mask)) == 1:
-                # Need to extrapolate
-                data = _extrapolate_out_mask(data.astype(np.float), bg_mask,
-                                            iterations=3)[0]
-            niimg = nb.Nifti1Image(data, niimg.affine,
-                                header=niimg.get_header())
-            del out_of_mask, bg_mask
-            # Resampling the file to target and saving the output in the "resampled"
-            # folder
-            resampled_file = os.path.join(resampled_path,
-                                        "%06d%s" % (row[1]['image_id'], ext))
-
-            print "Resampling %s" % orig_file
-            resampled_nii = resample_img(niimg, target_nii.get_affine(),
-                target_nii.shape)
-            resampled_nii = nb.Nifti1Image(resampled_nii.get_data().squeeze(),
-                                        resampled_nii.get_affine(),
-                                        header=niimg.get_header())
-            if len(resampled_nii.shape) == 3:
-                resampled_nii.to_filename(resampled_file)
-            else:
-                # We have a 4D file
-                assert len(resampled_nii.shape) == 4
-                resampled_data = resampled_nii.get_data()
-                affine = resampled_nii.affine
-                for index in range(resampled_nii.shape[-1]):
-                    # First save the files separately
-                    this_nii = nb.Nifti1Image(resampled_data[..., index],
-                                                affine)
-                    this_id = int("%i%i" % (-row[1]['image_id'], index))
-                    this_file = os.path.join(resampled_path,
-                        "%06d%s" % (this_id, ext))
-                    this_nii.to_filename(this_file)
-
-                    # Second, fix the dataframe
-                    out_df = out_df[out_df.image_id != row[1]['image_id']]
-                    this_row = row[1].copy()
-                    this_row.image_id = this_id
-                    out_df = out_df.append(this_row)
-        except IOError as e:
-            # Fix the dataframe
-            out_df = out_df[out_df.image_id != row[1]['image_id']]
-            print "Could not load %s " % orig_file
-            print e
-
-    return out_df
+            return _download(int(row['image_id']), row['file'],
+                             store) is not None
+        finally:
+            progress.step()
 
+    pool = ThreadPool(max(n_jobs, 1))
+    try:
+        downloaded = pool.map(download,
+                              [row for _, row in images_df.iterrows()])
+    finally:
+        pool.terminate()
+        store.flush()
+    return images_df[np.array(downloaded, dtype=np.bool)]
+
+
+def download_and_resample(images_df, dest_dir, target, n_jobs=1,
+                          n_download_jobs=4, incremental=False,
+                          resampled_format=None, report=None, refresh=True,
+                          resampled_dir="resampled"):
+    """Downloads all stat maps and resamples them to a common space.
 
-def get_frequency_map(images_df, dest_dir, target):
+    Downloads are done by n_download_jobs threads, handing the images
+    they fetched to a pool of n_jobs processes for the extrapolation and
+    the resampling, without waiting for them to be processed: the pool
+    is kept busy whatever n_download_jobs. Up to 2 * n_jobs images are
+    queued for processing, which bounds the number of images in flight.
+    The output DataFrame follows the order of images_df, whatever the
+    order in which images are processed.
+
+    The resampled maps are saved in the resampled_dir folder of dest_dir,
+    so that maps resampled to several targets (eg the levels of the mask
+    pyramid, see mask_pyramid) share the downloads.
+
+    Each processed image is recorded in a manifest in the resampled_dir
+    folder, with the sha1 of its original file and the processing
+    parameters. If incremental is True, images for which these have not
+    changed are not processed again.
+
+    The resampled maps are saved as compressed ('nii.gz') or
+    uncompressed ('nii') NIfTI files, or in the format of the original
+    file if resampled_format is None. The manifest records the files, so
+    that readers (see get_resampled_files) find them whatever the
+    format.
+
+    If refresh is False, the images already in the download store are
+    not checked against the server (see DownloadStore).
+
+    The timings, bytes downloaded, cache hits and errors are recorded in
+    the given RunReport (see instrumentation), and the progress printed.
     """
-    """
-    mask_img = 'gm_mask.nii.gz'
-    mask = nb.load(mask_img).get_data().astype(np.bool)
-
+    if resampled_format is not None and not resampled_format in \
+            RESAMPLED_FORMATS:
+        raise ValueError('Unknown resampled_format %r, should be one of %s'
+                         % (resampled_format, RESAMPLED_FORMATS))
 
+    if report is None:
+        report = RunReport()
     target_nii = nb.load(target)
-    resampled_path = os.path.join(dest_dir, "resampled")
-    freq_map_data = np.zeros(target_nii.shape)
-
-    n_images = 0
-    for row in combined_df.iterrows():
-        _, _, ext = split_filename(row[1]['file'])
-        orig_file = os.path.join(resampled_path,
-                                 "%06d%s" % (row[1]['image_id'], ext))
-        nb.load(orig_file)
-        if not os.path.exists(orig_file):
-            urllib.urlretrieve(row[1]['file'], orig_file)
-
-        resampled_nii = resample_img(orig_file, target_nii.get_affine(),
-                                     target_nii.shape,
-                                     interpolation="nearest")
-        data = resampled_nii.get_data().squeeze()
-        data[np.isnan(data)] = 0
-        data[np.logical_not(mask)] = 0
-        data = np.abs(data)
-
-        # Keep only things that are very significant
-        data = data > 3
-        if len(data.shape) == 4:
-            for d in np.rollaxis(data, -1):
-                freq_map_data += (d != 0)
-                n_images +=1
+    store = DownloadStore(os.path.join(dest_dir, "original"),
+                          refresh=refresh, report=report)
+    extrapolated_path = os.path.join(dest_dir, "extrapolated")
+    mkdir_p(extrapolated_path)
+    resampled_path = os.path.join(dest_dir, resampled_dir)
+    mkdir_p(resampled_path)
+    processed = Manifest(os.path.join(resampled_path, "manifest.json"))
+    # Changing any of these parameters invalidates the processed images
+    params = dict(target_affine=target_nii.get_affine().tolist(),
+                  target_shape=list(target_nii.shape),
+                  extrapolation_iterations=EXTRAPOLATION_ITERATIONS,
+                  four_d_files='single',
+                  resampled_format=resampled_format)
+
+    process_pool = None
+    if n_jobs != 1:
+        process_pool = Pool(n_jobs)
+        # The images downloaded, waiting for a worker or being processed
+        slots = threading.BoundedSemaphore(2 * n_jobs)
+    progress = report.progress('download_and_resample', len(images_df))
+
+    def record(image_id, sha1, ext, result):
+        image_ids, timings, error = result
+        for stage, seconds in timings.items():
+            report.record(stage, image_id, seconds)
+        if error is not None:
+            report.error('resampling', image_id, *error)
+        if image_ids:
+            processed.update(image_id, sha1=sha1, params=params,
+                             image_ids=image_ids,
+                             files=["%06d%s" % (image_id, ext)])
+
+    def process_row(row):
+        """ The image_ids of the row, or, if it is processed by the
+        pool, the AsyncResult of its processing
+        """
+        image_id = int(row['image_id'])
+        orig_file = _download(image_id, row['file'], store)
+        if orig_file is None:
+            progress.step()
+            return []
+        sha1 = store.sha1(image_id)
+        entry = processed.get(image_id)
+        if (incremental and entry is not None and entry['sha1'] == sha1
+                and entry['params'] == params
+                and all(os.path.exists(os.path.join(resampled_path, f))
+                        for f in entry['files'])):
+            report.count('resampling.cache_hit')
+            progress.step()
+            # The manifest may hold ids of an older scheme
+            return _volume_ids(image_id, len(entry['image_ids']))
+        report.count('resampling.cache_miss')
+
+        if resampled_format is None:
+            _, _, ext = split_filename(orig_file)
         else:
-            freq_map_data += data
-            n_images += 1
-
-    freq_map_data *= 100. / n_images
-
-    return nb.Nifti1Image(freq_map_data, target_nii.get_affine())
+            ext = '.' + resampled_format
+        args = (image_id, orig_file, sha1, extrapolated_path, resampled_path,
+                ext, target_nii.get_affine(), target_nii.shape)
+        if process_pool is None:
+            result = _extrapolate_and_resample(*args)
+            record(image_id, sha1, ext, result)
+            progress.step()
+            return result[0]
+
+        def callback(result):
+            # Called in the result thread of the pool
+            try:
+                record(image_id, sha1, ext, result)
+            finally:
+                slots.release()
+                progress.step()
+
+        slots.acquire()
+        return process_pool.apply_async(_extrapolate_and_resample, args,
+                                        callback=callback)
+
+    download_pool = ThreadPool(max(n_download_jobs, 1))
+    try:
+        # map returns the results in the order of the input rows
+        out_ids = download_pool.map(process_row,
+                                    [row for _, row in images_df.iterrows()])
+        out_ids = [these_ids if isinstance(these_ids, list)
+                   else these_ids.get()[0] for these_ids in out_ids]
+    finally:
+        download_pool.terminate()
+        if process_pool is not None:
+            process_pool.terminate()
+        store.flush()
+        processed.flush()
+
+    return _expand_rows(images_df, out_ids)
+
+
+def resample_to_data_matrix(images_df, dest_dir, data_dir,
+                            mask_img='gm_mask.nii.gz', batch_size=50):
+    """Resample the images straight onto the voxels of the mask, and write
+    a data matrix (see data_matrix) in data_dir, without writing resampled
+    files.
+
+    The interpolation is linear (see resampling): the matrix differs from
+    the one built from the resampled files, and is written in its own
+    directory, rather than in dest_dir.
+
+    Images sharing a grid are resampled with a sparse interpolation
+    operator computed once for that grid, batch_size images at a time
+    (see resampling). The images must already be in the download store.
+    Images that cannot be loaded or preprocessed are dropped, before
+    the matrix is written. Returns the dataframe of the rows of the
+    matrix.
+    """
+    mask_nii = nb.load(mask_img)
+    plans = ResamplingPlans(mask_nii.get_affine(),
+                            mask_nii.get_data().astype(np.bool))
+    store = DownloadStore(os.path.join(dest_dir, "original"), refresh=False)
+    extrapolated_path = os.path.join(dest_dir, "extrapolated")
+    mkdir_p(extrapolated_path)
+    mkdir_p(data_dir)
+
+    def preprocess(image_id, orig_file):
+        return preprocess_image(image_id, orig_file, store.sha1(image_id),
+                                extrapolated_path,
+                                iterations=EXTRAPOLATION_ITERATIONS)
+
+    # The images are preprocessed once here, so that the rows of the
+    # matrix are known before it is written: the decisions and the
+    # extrapolated images are cached, and reused when writing it
+    images = list()
+    out_ids = list()
+    try:
+        for _, row in images_df.iterrows():
+            image_id = int(row['image_id'])
+            orig_file = _download(image_id, row['file'], store)
+            these_ids = list()
+            if orig_file is not None:
+                try:
+                    niimg = preprocess(image_id, orig_file)
+                    n_volumes = int(np.prod(niimg.shape[3:]))
+                    these_ids = _volume_ids(image_id, n_volumes)
+                    images.append((image_id, orig_file))
+                except Exception as e:
+                    print "Could not process %s " % orig_file
+                    print e
+            out_ids.append(these_ids)
+    finally:
+        store.flush()
+
+    def rows():
+        for start in range(0, len(images), batch_size):
+            niimgs = [preprocess(image_id, orig_file)
+                      for image_id, orig_file in
+                      images[start:start + batch_size]]
+            for volumes in plans.resample(niimgs):
+                for volume in volumes:
+                    yield volume
+
+    out_df = _expand_rows(images_df, out_ids)
+    write_data_matrix(rows(), out_df['image_id'], mask_img, data_dir)
+    return out_df
 
 
-def url_get(url):
-    request = Request(url)
-    response = urlopen(request)
-    return response.read()
+def get_resampled_files(images_df, dest_dir, resampled_dir="resampled"):
+    """The names of the resampled files of the images, as recorded in the
+    manifest of the processed images: the volumes of a 4D image share its
+    file (see the 'volume' column)
+    """
+    resampled_path = os.path.join(dest_dir, resampled_dir)
+    processed = Manifest(os.path.join(resampled_path, "manifest.json"))
+    files = list()
+    for row in images_df.iterrows():
+        entry = processed.get(int(row[1]['source_image_id']))
+        if entry is not None:
+            this_file = entry['files'][0]
+        else:
+            # Images processed before the manifest existed
+            _, _, ext = split_filename(row[1]['file'])
+            this_file = "%06d%s" % (row[1]['source_image_id'], ext)
+        files.append(os.path.join(resampled_path, this_file))
+    return files
 
 
-def get_neurosynth_terms(combined_df):
-    """ Grab terms for each image, decoded with neurosynth"""
-    terms = list()
-    from sklearn.feature_extraction import DictVectorizer
-    vectorizer = DictVectorizer()
-    image_ids = list()
-    for row in combined_df.iterrows():
-        image_id = row[1]['image_id']
-        image_ids.append(int(image_id))
-        print "Fetching terms for image %i" % image_id
-        image_url = row[1]['url_image'].split('/')[-2]
+def _accumulate_frequency(accumulator, files, volumes, map_types,
+                          target_affine, target_shape):
+    """Add the given volumes to the accumulator. Returns it, and the time
+    spent on each volume.
+    """
+    load = lambda this_file: load_in_target(this_file, target_affine,
+                                            target_shape)
+    timings = list()
+    t0 = time.time()
+    for data, map_type in zip(iter_volumes(files, volumes, load=load),
+                              map_types):
+        accumulator.add(data, map_type=map_type)
+        t1 = time.time()
+        timings.append(t1 - t0)
+        t0 = t1
+    return accumulator, timings
+
+
+def get_frequency_maps(images_df, dest_dir, target, thresholds=(3, ),
+                       tails=('absolute', ), mask_img='gm_mask.nii.gz',
+                       n_jobs=1, report=None, resampled_dir="resampled"):
+    """Compute maps of frequency of activation, for several thresholds
+    and tails, for all the maps and for each map type, in a single pass
+    over the resampled maps.
+
+    The maps are returned as a dictionary of Nifti1Images indexed by
+    (map_type, tail, threshold), where map_type is 'all' for all maps.
+    With n_jobs > 1, batches of maps are accumulated in parallel and
+    merged.
+
+    The time spent on each map is recorded in the given RunReport (see
+    instrumentation), and the progress printed.
+    """
+    if report is None:
+        report = RunReport()
+    mask = nb.load(mask_img).get_data().astype(np.bool)
+    target_nii = nb.load(target)
 
+    files = get_resampled_files(images_df, dest_dir,
+                                resampled_dir=resampled_dir)
+    volumes = list(images_df['volume'])
+    map_types = list(images_df['map_type'])
+    image_ids = list(images_df['image_id'])
+    progress = report.progress('frequency_maps', len(files))
+
+    def record(start, timings):
+        for image_id, seconds in zip(image_ids[start:], timings):
+            report.record('frequency_maps', image_id, seconds)
+        progress.step(len(timings))
+
+    accumulator = FrequencyAccumulator(mask, thresholds=thresholds,
+                                       tails=tails)
+    args = (target_nii.get_affine(), target_nii.shape)
+    if n_jobs == 1:
+        # By batches, to report the progress
+        for start in range(0, len(files), 100):
+            stop = start + 100
+            _, timings = _accumulate_frequency(accumulator,
+                                               files[start:stop],
+                                               volumes[start:stop],
+                                               map_types[start:stop], *args)
+            record(start, timings)
+    else:
+        pool = Pool(n_jobs)
         try:
-            elevations = mem.cache(url_get)(
-                        'http://neurosynth.org/decode/data/?neurovault=%s'
-                        % image_url)
-            data = json.loads(elevations)['data']
-            data = dict([(i['analysis'], i['r']) for i in data])
-        except HTTPError:
-            data = {}
-        terms.append(data)
-    X = vectorizer.fit_transform(terms).toarray()
-    term_dframe = dict([('neurosynth decoding %s' % name, X[:, idx])
-                        for name, idx in vectorizer.vocabulary_.items()])
-    term_dframe['image_id'] = image_ids
-
-    return pd.DataFrame(term_dframe)
-
-
-
+            # Batches split at the first rows of files, so that the
+            # volumes of a 4D file (contiguous rows) are in the same batch
+            file_starts = [idx for idx in range(len(files))
+                           if idx == 0 or files[idx] != files[idx - 1]]
+            file_starts.append(len(files))
+            batches = list()
+            for these_files in np.array_split(
+                                np.arange(len(file_starts) - 1), n_jobs):
+                if not len(these_files):
+                    continue
+                batch = FrequencyAccumulator(mask, thresholds=thresholds,
+                                             tails=tails)
+                start = file_starts[these_files[0]]
+                stop = file_starts[these_files[-1] + 1]
+                batches.append((start, pool.apply_async(_accumulate_frequency,
+                    (batch, files[start:stop], volumes[start:stop],
+                     map_types[start:stop]) + args)))
+            for start, batch in batches:
+                batch, timings = batch.get()
+                accumulator.merge(batch)
+                record(start, timings)
+        finally:
+            pool.terminate()
+
+    return accumulator.get_maps(target_nii.get_affine())
+
+
+def get_frequency_map(images_df, dest_dir, target, threshold=3,
+                      report=None):
+    """Compute the map of frequency of activation: the percentage of maps
+    in which each voxel has an absolute value above threshold.
+    """
+    maps = get_frequency_maps(images_df, dest_dir, target,
+                              thresholds=(threshold, ), report=report)
+    return maps[('all', 'absolute', threshold)]
 
-if __name__ == '__main__':
-    #mem.clear()
-    combined_df = mem.cache(get_images_with_collections_df)()
 
-    # The following maps are not brain maps
-    faulty_ids = [96, 97, 98]
-    # And the following are crap
-    faulty_ids.extend([338, 339])
-    # 335 is a duplicate of 336
-    faulty_ids.extend([335, ])
-    combined_df = combined_df[~combined_df.image_id.isin(faulty_ids)]
+def get_neurosynth_terms(combined_df,
+                         cache_dir='/tmp/neurovault_analysis/cache/neurosynth',
+                         n_jobs=4, terms_file=None, report=None):
+    """ Grab terms for each image, decoded with neurosynth
 
-    print combined_df[['DOI', 'url_collection', 'name_image', 'file']]
+    The images are decoded concurrently, and the decodings cached in
+    cache_dir. Returns the sparse (n_images, n_terms) matrix of the
+    terms, and the terms. If terms_file is given, they are saved in it.
+    The timings, cache hits and errors are recorded in the given
+    RunReport (see instrumentation).
+    """
+    client = DecodingClient(cache_dir, n_jobs=n_jobs, report=report)
+    image_ids = [int(image_id) for image_id in combined_df['image_id']]
+    decodings = client.decode([url.split('/')[-2]
+                               for url in combined_df['url_image']])
+    X, terms = decodings_to_matrix(decodings)
+    if terms_file is not None:
+        save_term_matrix(terms_file, X, terms, image_ids)
 
-    #restrict to Z-, F-, or T-maps
-    combined_df = combined_df[combined_df['map_type'].isin(["Z","F","T"])]
-    terms_df = get_neurosynth_terms(combined_df)
-    print combined_df["name_collection"].value_counts()
-    combined_df = combined_df.merge(terms_df, on=['image_id', ])
+    return X, terms
 
-    dest_dir = "/tmp/neurovault_analysis"
-    target = "/usr/share/fsl/data/standard/MNI152_T1_2mm.nii.gz"
 
-    combined_df = mem.cache(download_and_resample)(combined_df,
-                                                   dest_dir, target)
 
-    # Now remove -3360, -3362, and -3364, that are mean images, and not Z
-    # scores
-    not_Zscr = [-3360, -3362, -3364]
-    combined_df = combined_df[~combined_df.image_id.isin(not_Zscr)]
 
-    # Now remove images that are ugly, or obviously not z maps:
-    broken = [1202, 1163, 1931, 1101, 1099]
-    combined_df = combined_df[~combined_df.image_id.isin(broken)]
+if __name__ == '__main__':
+    # Bring all the stages up to date (see pipeline.py to run them one
+    # by one, and for the options)
+    from pipeline import main as run_pipeline
+    from term_matrix import load_term_matrix
+    config = run_pipeline(['all'] + sys.argv[1:])
+    dest_dir = config.level_dir
+    target = config.target
 
-    combined_df.to_csv('%s/metadata.csv' % dest_dir, encoding='utf8')
+    term_matrix, term_names, _ = load_term_matrix(
+        os.path.join(dest_dir, 'terms.npz'))
 
 
     #--------------------------------------------------
     # Plot a map of frequency of activation
-    freq_nii = get_frequency_map(combined_df, dest_dir, target)
+    freq_nii = nb.load(os.path.join(dest_dir, 'freq_map.nii.gz'))
     freq_nii.to_filename("freq_map.nii.gz")
 
-    display = plot_anat("/usr/share/fsl/data/standard/MNI152_T1_2mm.nii.gz",
-                        display_mode='z',
-                        cut_coords=np.linspace(-30, 60, 7))
-    display.add_overlay(freq_nii, vmin=0, cmap=plt.cm.hot,
-                        colorbar=True)
-    display._colorbar_ax.set_yticklabels(["% 3i" % float(t.get_text())
-            for t in display._colorbar_ax.yaxis.get_ticklabels()])
-    display.title('Percentage of activations (Z or T > 3)')
-
-    display.savefig('activation_frequency.png')
-    display.savefig('activation_frequency.pdf')
+    # Rendered again only if the map changed
+    render_figures([Figure('freq_map.nii.gz',
+                           ['activation_frequency.png',
+                            'activation_frequency.pdf'],
+                           dict(kind='overlay', bg_img=target,
+                                display_mode='z',
+                                cut_coords=np.linspace(-30, 60, 7).tolist(),
+                                vmin=0, cmap='hot', colorbar=True,
+                                percent_ticks=True,
+                                title='Percentage of activations '
+                                      '(Z or T > 3)'))])
 
 
     #--------------------------------------------------
     # Plot the frequency of occurence of neurosynth terms
-    # Use the terms from neurosynth to label the ICAs
-    terms = combined_df[[c for c in combined_df.columns
-                         if c.startswith('neurosynth decoding')]]
-    terms = terms.fillna(0)
-    term_matrix = terms.as_matrix()
     # Labels that have a negative correlation are not present in the map
-    term_matrix[term_matrix < 0] = 0
-
-    term_names = [c[20:] for c in combined_df.columns
-                  if c.startswith('neurosynth decoding')]
+    term_matrix = clip_negative(term_matrix)
 
     plt.figure(figsize=(5, 20))
-    plt.barh(np.arange(len(term_names)), term_matrix.sum(axis=0))
+    plt.barh(np.arange(len(term_names)),
+             np.asarray(term_matrix.sum(axis=0)).ravel())
     plt.axis('off')
     plt.axis('tight')
     plt.tight_layout()
@@ -0,0 +1,445 @@
+"""
+The command line entry point of the pipeline: each stage can be run on
+its own, on a cache directory that can be shared.
+
+    python pipeline.py fetch --cache-dir /data/neurovault
+    python pipeline.py resample --jobs 8 --target MNI152_T1_2mm.nii.gz
+    python pipeline.py freq-map
+
+A stage first brings its dependencies up to date. A stage is up to date,
+and skipped, if it completed with the same parameters after the last run
+of each of its dependencies. The catalogue is also out of date after
+--max-age hours (24 by default), so that a periodic run of all the stages
+picks up the new images and checks the downloads again. With --force, a
+stage is run even if it is up to date, and 'all --force' runs all the
+stages. Each completed stage leaves a stamp in the 'stages' directory of
+the cache, and its run report (see instrumentation) in the 'reports'
+directory.
+
+The stages are:
+
+* fetch: the catalogue of the images, from the NeuroVault API: only the
+  images modified since the last fetch are transferred, unless --force
+* download: the files of the images
+* resample: the maps resampled to the target, and their metadata
+* decode: the NeuroSynth terms of the maps, from neurosynth.org, or
+  offline with the term maps given by --term-maps (see term_decoder)
+* build-matrix: the data matrix of the maps, masked
+* sparse-matrix: a data matrix resampled straight from the downloads
+  onto the mask, with linear interpolation, in the 'sparse_matrix'
+  directory (see resampling)
+* freq-map: the map of the frequency of activation
+* index: the similarity index of the maps (see similarity_index)
+* all: all the stages, but the index
+
+With --level 3 or 4, the maps are resampled to the 3mm or 4mm level of
+the pyramid of the mask (see mask_pyramid), which is also their target,
+and the stages after download write in the '3mm' or '4mm' directory of
+the cache: the downloads are shared by the levels.
+"""
+# License: BSD
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import namedtuple
+
+import pandas as pd
+
+from neurovault_datagrabber import (NEUROVAULT_API,
+                                    get_images_with_collections_df,
+                                    download_images, download_and_resample,
+                                    resample_to_data_matrix,
+                                    get_resampled_files, get_frequency_maps,
+                                    get_neurosynth_terms)
+from data_matrix import build_data_matrix, mask_hash
+from metadata_store import save_metadata, load_metadata
+from instrumentation import RunReport
+from fileutils import mkdir_p, write_json
+from term_matrix import save_term_matrix
+from term_decoder import TermDecoder, read_term_maps_header
+from similarity_index import build_index
+from mask_pyramid import (LEVELS, level_filename, pyramid_filename,
+                          build_pyramid)
+
+DEFAULT_CACHE_DIR = '/tmp/neurovault_analysis'
+
+DEFAULT_TARGET = os.path.join(os.environ.get('FSLDIR', '/usr/share/fsl'),
+                              'data', 'standard', 'MNI152_T1_2mm.nii.gz')
+
+DEFAULT_EXCLUDE_FILE = os.path.join(os.path.dirname(os.path.abspath(
+                                        __file__)), 'excluded_images.txt')
+
+# The types of maps analysed
+MAP_TYPES = ('Z', 'F', 'T')
+
+# The threshold of the frequency map
+FREQUENCY_THRESHOLD = 3
+
+# The stages that are out of date after config.max_age hours
+EXPIRING = ('fetch', )
+
+# The dimension of the random projection of the similarity index, and
+# its number of clusters
+INDEX_COMPONENTS = 1024
+INDEX_LISTS = 'auto'
+
+
+def read_exclude_file(filename):
+    """ The image_ids listed in an exclusion file: one per line, '#'
+    starting a comment
+    """
+    if filename is None:
+        return []
+    image_ids = set()
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                image_ids.add(int(line))
+    return sorted(image_ids)
+
+
+def _excluded(images_df, config):
+    excluded = read_exclude_file(config.exclude_file)
+    return images_df[~images_df['image_id'].isin(excluded)]
+
+
+def _metadata_dir(config):
+    return os.path.join(config.level_dir, 'metadata')
+
+
+def _selected_images(config):
+    """ The images of the catalogue to download and resample """
+    images_df = load_metadata(os.path.join(config.cache_dir, 'catalogue'))
+    images_df = _excluded(images_df, config)
+    return images_df[images_df['map_type'].isin(MAP_TYPES)]
+
+
+###############################################################################
+# The stages
+
+def _modify_dates(images_df):
+    # Collections have a modify_date too
+    for name in ('modify_date_image', 'modify_date'):
+        if name in images_df.columns:
+            return images_df[name]
+    return pd.Series([])
+
+
+def fetch(config, report):
+    """ Fetch the images modified since the last fetch, and update the
+    catalogue with them (all the images with --force)
+    """
+    catalogue_dir = os.path.join(config.cache_dir, 'catalogue')
+    old_df = None
+    since = None
+    if (not config.force
+            and os.path.exists(os.path.join(catalogue_dir, 'schema.json'))):
+        old_df = load_metadata(catalogue_dir)
+        dates = _modify_dates(old_df).dropna()
+        if len(dates):
+            since = dates.max()
+        else:
+            old_df = None
+    images_df = get_images_with_collections_df(api_url=config.api_url,
+                                               n_jobs=config.jobs,
+                                               since=since)
+    print "Fetched %i images" % len(images_df)
+    if old_df is not None:
+        if len(images_df):
+            old_df = old_df[~old_df['image_id'].isin(images_df['image_id'])]
+            old_df = old_df.copy()
+            # The categorical columns of the store would give mixed
+            # dtypes (or NaN) concatenated with the new records
+            for name in old_df.columns:
+                if old_df[name].dtype.name == 'category':
+                    old_df[name] = old_df[name].astype(object)
+            images_df = pd.concat([old_df, images_df], ignore_index=True)
+        else:
+            images_df = old_df
+    save_metadata(images_df, catalogue_dir)
+
+
+def download(config, report):
+    images_df = _selected_images(config)
+    downloaded = download_images(images_df, config.cache_dir,
+                                 n_jobs=config.jobs, report=report)
+    print "Downloaded %i images out of %i" % (len(downloaded),
+                                              len(images_df))
+
+
+def resample(config, report):
+    # The download stage has fetched the images: they are not checked
+    # against the server again
+    images_df = download_and_resample(_selected_images(config),
+                                      config.cache_dir, config.target,
+                                      n_jobs=config.jobs, incremental=True,
+                                      resampled_format='nii', report=report,
+                                      refresh=False,
+                                      resampled_dir=config.resampled_dir)
+    # Exclude also the volumes of 4D images
+    images_df = _excluded(images_df, config)
+    images_df['resampled_file'] = get_resampled_files(
+                    images_df, config.cache_dir,
+                    resampled_dir=config.resampled_dir)
+    images_df.to_csv(os.path.join(config.level_dir, 'metadata.csv'),
+                     encoding='utf8')
+    # The typed, columnar version, that the analysis scripts load
+    save_metadata(images_df, _metadata_dir(config))
+
+
+def decode(config, report):
+    terms_file = os.path.join(config.level_dir, 'terms.npz')
+    if config.term_maps is not None:
+        images_df = load_metadata(_metadata_dir(config),
+                                  columns=['image_id', 'resampled_file',
+                                           'volume'])
+        decoder = TermDecoder.load(config.term_maps, config.mask)
+        scores = decoder.decode_files(images_df['resampled_file'],
+                                      config.mask,
+                                      volumes=images_df['volume'],
+                                      n_jobs=config.jobs)
+        save_term_matrix(terms_file, scores, decoder.terms,
+                         images_df['image_id'])
+        return
+    images_df = load_metadata(_metadata_dir(config),
+                              columns=['image_id', 'url_image'])
+    get_neurosynth_terms(images_df,
+                         cache_dir=os.path.join(config.cache_dir, 'cache',
+                                                'neurosynth'),
+                         n_jobs=config.jobs, terms_file=terms_file,
+                         report=report)
+
+
+def build_matrix(config, report):
+    images_df = load_metadata(_metadata_dir(config),
+                              columns=['image_id', 'resampled_file',
+                                       'volume'])
+    build_data_matrix(images_df['resampled_file'], images_df['image_id'],
+                      config.mask, config.level_dir,
+                      volumes=images_df['volume'], n_jobs=config.jobs)
+
+
+def sparse_matrix(config, report):
+    images_df = _selected_images(config)
+    out_df = resample_to_data_matrix(images_df, config.cache_dir,
+                                     os.path.join(config.level_dir,
+                                                  'sparse_matrix'),
+                                     mask_img=config.mask)
+    print "Resampled %i maps onto the mask" % len(out_df)
+
+
+def freq_map(config, report):
+    images_df = load_metadata(_metadata_dir(config),
+                              columns=['image_id', 'source_image_id',
+                                       'file', 'volume', 'map_type'])
+    maps = get_frequency_maps(images_df, config.cache_dir, config.target,
+                              thresholds=(FREQUENCY_THRESHOLD, ),
+                              mask_img=config.mask, n_jobs=config.jobs,
+                              report=report,
+                              resampled_dir=config.resampled_dir)
+    maps[('all', 'absolute', FREQUENCY_THRESHOLD)].to_filename(
+                        os.path.join(config.level_dir, 'freq_map.nii.gz'))
+
+
+def index(config, report):
+    build_index(config.level_dir, config.mask, n_components=INDEX_COMPONENTS,
+                n_lists=INDEX_LISTS)
+
+
+# The parameters of a stage: if they change, the stage is run again.
+# The number of jobs is not one of them: it does not change the results.
+# The stamps of the stages per_level are in the directory of the level.
+Stage = namedtuple('Stage', ('run', 'dependencies', 'params', 'per_level'))
+
+STAGES = {
+    'fetch': Stage(fetch, (), lambda config: dict(api_url=config.api_url),
+                   False),
+    'download': Stage(download, ('fetch', ),
+                      lambda config: dict(
+                          excluded=read_exclude_file(config.exclude_file)),
+                      False),
+    'resample': Stage(resample, ('download', ),
+                      lambda config: dict(
+                          target=os.path.abspath(config.target),
+                          excluded=read_exclude_file(config.exclude_file),
+                          # The scheme of the ids of the volumes
+                          volume_ids=2),
+                      True),
+    'decode': Stage(decode, ('resample', ),
+                    lambda config: dict(
+                        term_maps=None if config.term_maps is None
+                        else read_term_maps_header(
+                                config.term_maps)['maps_hash']),
+                    True),
+    'build-matrix': Stage(build_matrix, ('resample', ),
+                          lambda config: dict(mask=mask_hash(config.mask)),
+                          True),
+    'sparse-matrix': Stage(sparse_matrix, ('download', ),
+                           lambda config: dict(
+                               mask=mask_hash(config.mask),
+                               excluded=read_exclude_file(
+                                            config.exclude_file)),
+                           True),
+    'freq-map': Stage(freq_map, ('resample', ),
+                      lambda config: dict(
+                          target=os.path.abspath(config.target),
+                          mask=mask_hash(config.mask),
+                          threshold=FREQUENCY_THRESHOLD),
+                      True),
+    'index': Stage(index, ('build-matrix', ),
+                   lambda config: dict(mask=mask_hash(config.mask),
+                                       n_components=INDEX_COMPONENTS,
+                                       n_lists=INDEX_LISTS),
+                   True),
+    'all': Stage(None, ('decode', 'build-matrix', 'freq-map'),
+                 lambda config: dict(), True),
+}
+
+
+###############################################################################
+# The runner
+
+def _stage_dir(config, name):
+    if STAGES[name].per_level:
+        return config.level_dir
+    return config.cache_dir
+
+
+def _stamp_file(config, name):
+    return os.path.join(_stage_dir(config, name), 'stages', '%s.json' % name)
+
+
+def read_stamp(config, name):
+    """ The stamp of the last completed run of a stage, or None """
+    filename = _stamp_file(config, name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _write_json(filename, content):
+    mkdir_p(os.path.dirname(filename))
+    write_json(filename, content)
+
+
+def run_stage(name, config, force=False, recursive=False, _done=None):
+    """ Run a stage, if it is not up to date, after bringing its
+    dependencies up to date. If force is True, the stage is run even if
+    it is up to date, and so are its dependencies if recursive is True or
+    if the stage only groups other stages (as 'all').
+    """
+    if _done is None:
+        _done = set()
+    if name in _done:
+        return
+    stage = STAGES[name]
+    recursive = force and (recursive or stage.run is None)
+    for dependency in stage.dependencies:
+        run_stage(dependency, config, force=recursive, recursive=recursive,
+                  _done=_done)
+    _done.add(name)
+
+    # The JSON round trip, to compare with the stamp
+    params = json.loads(json.dumps(stage.params(config)))
+    inputs = dict((dependency, read_stamp(config, dependency)['finished'])
+                  for dependency in stage.dependencies)
+    stamp = read_stamp(config, name)
+    expired = (stamp is not None and name in EXPIRING
+               and time.time() - stamp['finished'] > 3600 * config.max_age)
+    if (not force and stamp is not None and stamp['params'] == params
+            and stamp['inputs'] == inputs and not expired):
+        print "Stage %s is up to date" % name
+        return
+    if stage.run is None:
+        return
+
+    print "Running stage %s" % name
+    report = RunReport()
+    stage.run(config, report)
+    _write_json(os.path.join(_stage_dir(config, name), 'reports',
+                             '%s.json' % name),
+                report.summary())
+    report.print_summary()
+    _write_json(_stamp_file(config, name),
+                dict(params=params, inputs=inputs, finished=time.time()))
+
+
+def get_parser():
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--jobs', '-j', type=int, default=4,
+                         help='the number of parallel jobs (default: 4)')
+    options.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                         help='the directory of the data, that can be '
+                              'shared (default: %(default)s)')
+    options.add_argument('--target', default=DEFAULT_TARGET,
+                         help='the image defining the space of the '
+                              'resampled maps (default: %(default)s)')
+    options.add_argument('--exclude-file', default=DEFAULT_EXCLUDE_FILE,
+                         help='the file of the image_ids to exclude '
+                              '(default: %(default)s)')
+    options.add_argument('--mask', default='gm_mask.nii.gz',
+                         help='the mask of the data matrix and of the '
+                              'frequency map (default: %(default)s)')
+    options.add_argument('--level', type=int, choices=LEVELS, default=2,
+                         help='the voxel size (mm) of the level of the '
+                              'pyramid of the mask to work at (default: '
+                              '%(default)s)')
+    options.add_argument('--term-maps', default=None,
+                         help='the directory of the term maps to decode '
+                              'offline (default: decode with '
+                              'neurosynth.org)')
+    options.add_argument('--api-url', default=NEUROVAULT_API,
+                         help='the NeuroVault API (default: %(default)s)')
+    options.add_argument('--max-age', type=float, default=24,
+                         help='the age (hours) after which the catalogue '
+                              'is fetched again (default: %(default)s)')
+    options.add_argument('--force', action='store_true',
+                         help='run the stage even if it is up to date')
+
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__[__doc__.index('The stages are'):])
+    subparsers = parser.add_subparsers(dest='stage')
+    for name in sorted(STAGES):
+        subparsers.add_parser(name, parents=[options])
+    return parser
+
+
+def set_level(config):
+    """ The target, the mask and the directories of the level of the
+    configuration
+    """
+    level_mask = level_filename(config.mask, config.level)
+    if level_mask != config.mask and not (
+            os.path.exists(level_mask)
+            and os.path.exists(pyramid_filename(config.mask))):
+        # The pyramid only needs the mask
+        print "Building the pyramid of %s" % config.mask
+        build_pyramid(config.mask)
+    if level_mask == config.mask:
+        config.level_dir = config.cache_dir
+        config.resampled_dir = 'resampled'
+    else:
+        # The mask of the level defines its grid
+        config.target = config.mask = level_mask
+        config.level_dir = os.path.join(config.cache_dir,
+                                        '%imm' % config.level)
+        config.resampled_dir = 'resampled_%imm' % config.level
+        mkdir_p(config.level_dir)
+    return config
+
+
+def main(argv=None):
+    config = set_level(get_parser().parse_args(argv))
+    run_stage(config.stage, config, force=config.force)
+    return config
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
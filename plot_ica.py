@@ -8,60 +8,66 @@ maps using the labels inferred from the NeuroVault decoding.
 import os
 
 import numpy as np
-import pandas as pd
 from scipy import stats
 
-from matplotlib import pyplot as plt
 from sklearn.decomposition import FastICA
 
 from nilearn.input_data import NiftiMasker
-from nilearn.plotting import plot_stat_map
+
+from data_matrix import load_data_matrix
+from decomposition import ReducedICA
+from figures import Figure, render_figures
+from metadata_store import load_metadata
+from term_matrix import load_term_matrix, clip_negative
 
 # -------------------------------------------
 # load data and metadata
 data_dir = "/tmp/neurovault_analysis"
 mask = 'gm_mask.nii.gz'
 
-metadata = pd.DataFrame.from_csv(os.path.join(data_dir, 'metadata.csv'))
+metadata = load_metadata(os.path.join(data_dir, 'metadata'),
+                         columns=['image_id'])
 
-images = [os.path.join(data_dir, 'resampled',
-                       '%06d.nii.gz' % row[1]['image_id'])
-          for row in metadata.iterrows()]
+masker = NiftiMasker(mask_img=mask).fit()
+X = load_data_matrix(data_dir, mask, image_ids=metadata['image_id'])
 
-masker = NiftiMasker(mask_img=mask, memory=os.path.join(data_dir, 'cache'))
-X = masker.fit_transform(images)
+# Set a memory ceiling (in MB) to reduce the data chunk by chunk before
+# the ICA, for catalogues that do not fit in memory
+memory_limit = None
 
-fast_ica = FastICA(n_components=20, random_state=42)
+if memory_limit is None:
+    fast_ica = FastICA(n_components=20, random_state=42)
+else:
+    fast_ica = ReducedICA(n_components=20, memory_limit=memory_limit,
+                          random_state=42)
 ica_maps = fast_ica.fit_transform(X.T).T
 
 ica_img = masker.inverse_transform(ica_maps)
 ica_img.to_filename('ica.nii.gz')
 
 # Use the terms from neurosynth to label the ICAs
-terms = metadata[[c for c in metadata.columns
-                  if c.startswith('neurosynth decoding')]]
-terms = terms.fillna(0)
-term_matrix = terms.as_matrix()
+term_matrix, col_names, _ = load_term_matrix(
+    os.path.join(data_dir, 'terms.npz'), image_ids=metadata['image_id'])
 # Labels that have a negative correlation are not present in the map
-term_matrix[term_matrix < 0] = 0
+term_matrix = clip_negative(term_matrix)
 
 ## tf-idf like weighting
-#idf = term_matrix.sum(axis=0)
+#idf = np.asarray(term_matrix.sum(axis=0)).ravel()
 #idf[idf == 0] = 1
 ## Log transform of the idf
 #idf = np.log(idf.sum() / idf)
-#term_matrix *= idf
+#term_matrix = term_matrix.multiply(idf).tocsr()
 
 # Don't use the transform method as it centers the data
-ica_terms = np.dot(term_matrix.T, fast_ica.components_.T).T
-col_names = [c[20:] for c in metadata.columns
-             if c.startswith('neurosynth decoding')]
+ica_terms = term_matrix.T.dot(fast_ica.components_.T).T
 
 if not os.path.exists('ica_maps'):
     os.mkdir('ica_maps')
 
 # -------------------------------------------
-# Generate figures
+# Generate figures, in parallel: only the components that changed are
+# rendered again
+figures = list()
 for idx, (ic, ic_terms) in enumerate(zip(ica_maps, ica_terms)):
     if -ic.min() > ic.max():
         # Flip the map's sign for prettiness
@@ -72,9 +78,12 @@ for idx, (ic, ic_terms) in enumerate(zip(ica_maps, ica_terms)):
     ic_img = masker.inverse_transform(ic)
     # Use the 4 terms weighted most as a title
     important_terms = np.array(col_names)[np.argsort(ic_terms)[-4:]]
-    display = plot_stat_map(ic_img, threshold=ic_thr, colorbar=False)
-    display.title(', '.join(important_terms[::-1]), size=16)
-    plt.savefig('ica_maps/component_%i_ic.png' % idx)
-    plt.savefig('ica_maps/component_%i_ic.pdf' % idx)
+    figures.append(Figure(ic_img, ['ica_maps/component_%i_ic.png' % idx,
+                                   'ica_maps/component_%i_ic.pdf' % idx],
+                          dict(threshold=float(ic_thr), colorbar=False,
+                               title=', '.join(important_terms[::-1]),
+                               title_size=16)))
+
+render_figures(figures, manifest_file='ica_maps/figures.json', n_jobs=4)
 
 
@@ -1,14 +1,15 @@
 import os
 
-import pandas as pd
-
-from scipy import stats
-from matplotlib import pyplot as plt
+import numpy as np
 
 from nilearn.input_data import NiftiMasker
-from nilearn.plotting import plot_stat_map
 
-from text_analysis import GROUP_NAMES, extract_documents, vectorize
+from data_matrix import load_data_matrix
+from figures import Figure, render_figures
+from group_stats import group_t_maps, permutation_thresholds
+from metadata_store import load_metadata
+from text_analysis import (GROUP_NAMES, IMAGE_TEXT_COLUMNS, extract_documents,
+                           vectorize)
 
 
 # -------------------------------------------
@@ -17,62 +18,73 @@ from text_analysis import GROUP_NAMES, extract_documents, vectorize
 data_dir = "/tmp/neurovault_analysis"
 mask = 'gm_mask.nii.gz'
 
-metadata = pd.DataFrame.from_csv(os.path.join(data_dir, 'metadata.csv'))
-
-images = [os.path.join(data_dir, 'resampled',
-                       '%06d.nii.gz' % row[1]['image_id'])
-          for row in metadata.iterrows()]
+metadata = load_metadata(os.path.join(data_dir, 'metadata'),
+                         columns=['image_id'] + list(IMAGE_TEXT_COLUMNS))
 
-masker = NiftiMasker(mask_img=mask, memory=os.path.join(data_dir, 'cache'))
-X = masker.fit_transform(images)
+masker = NiftiMasker(mask_img=mask).fit()
+X = load_data_matrix(data_dir, mask, image_ids=metadata['image_id'])
 
 documents = extract_documents(metadata)
 term_freq = vectorize(documents)
 
 all_img = masker.inverse_transform(X.mean(axis=0))
 all_img.to_filename('all.nii.gz')
-display = plot_stat_map(all_img, cut_coords=(-32, -16, 0, 28, 48, 62),
-                        colorbar=False,
-                        display_mode='z')
-display.title('all: %i maps' % len(X), size=17)
-display.savefig('all.png')
-display.savefig('all.pdf')
-display = plot_stat_map(all_img, cut_coords=(0, ),
-                        colorbar=True,
-                        display_mode='x')
-display.savefig('all_x.png')
-display.savefig('all_x.pdf')
-
-
-for name, term_vector in zip(GROUP_NAMES, term_freq.T):
+# The figures are rendered at the end, in parallel: only those whose map
+# changed are rendered again
+figures = [Figure('all.nii.gz', ['all.png', 'all.pdf'],
+                  dict(cut_coords=(-32, -16, 0, 28, 48, 62),
+                       colorbar=False,
+                       display_mode='z',
+                       title='all: %i maps' % len(X), title_size=17)),
+           Figure('all.nii.gz', ['all_x.png', 'all_x.pdf'],
+                  dict(cut_coords=(0, ),
+                       colorbar=True,
+                       display_mode='x'))]
+
+
+# The means and the t statistics of all the groups, in one pass over the
+# data
+groups = term_freq != 0
+means, t_maps = group_t_maps(X, groups)
+
+# Set to a number of permutations to threshold the t maps with a
+# permutation test, rather than with T = 5
+n_permutations = 0
+if n_permutations:
+    thresholds = permutation_thresholds(X, groups,
+                                        n_permutations=n_permutations)
+else:
+    # The threshold of T = 5 corresponds to an FWER correction on a 3x3x3
+    # gm grid.
+    thresholds = 5. * np.ones(len(GROUP_NAMES))
+
+for name, term_vector, mean, diff, threshold in zip(
+        GROUP_NAMES, groups.T, means, t_maps, thresholds):
     # The mean image
-    term_img = masker.inverse_transform(X[term_vector != 0].mean(axis=0))
+    term_img = masker.inverse_transform(mean)
     term_img.to_filename('%s.nii.gz' % name)
 
     #display = plot_stat_map(term_img, cut_coords=(-14, 8, 26, 44, 54),
     #                        colorbar=False, display_mode='z')
-    #display.title('%s: %i maps' % (name, (term_vector != 0).sum()),
+    #display.title('%s: %i maps' % (name, term_vector.sum()),
     #              size=17)
     #display.savefig('%s.png' % name)
     #display.savefig('%s.pdf' % name)
 
     # The fraction of activated voxels, in ratio of how often the
     # corresponding voxels are activated in the full database
-    diff = stats.ttest_ind(X[term_vector != 0],
-                           X[term_vector == 0])[0]
     term_img = masker.inverse_transform(diff)
     term_img.to_filename('%s_relative.nii.gz' % name)
 
-    # The threshold of T = 5 corresponds to an FWER correction on a 3x3x3
-    # gm grid.
-    display = plot_stat_map(term_img, cut_coords=(-14, 8, 26, 44, 54),
-                            #colorbar=False,
-                            threshold=5.,
-                            display_mode='z',
-                            vmax=12.)
-    display.title('%s: %i maps' % (name, (term_vector != 0).sum()),
-                  size=17)
-    display.savefig('%s_t_stat.png' % name)
-    display.savefig('%s_t_stat.pdf' % name)
-
-plt.show()
+    figures.append(Figure('%s_relative.nii.gz' % name,
+                          ['%s_t_stat.png' % name, '%s_t_stat.pdf' % name],
+                          dict(cut_coords=(-14, 8, 26, 44, 54),
+                               #colorbar=False,
+                               threshold=float(threshold),
+                               display_mode='z',
+                               vmax=12.,
+                               title='%s: %i maps' % (name,
+                                                      term_vector.sum()),
+                               title_size=17)))
+
+render_figures(figures, n_jobs=4)
@@ -6,13 +6,17 @@
 #import urllib, os, errno
 #from urllib2 import Request, urlopen, HTTPError
 
+import os
+
 import numpy as np
 import pylab as plt
 
 from nilearn.plotting.img_plotting import plot_anat
 
 from neurosynth.base.dataset import Dataset
-from neurosynth.analysis import meta
+
+from meta_analysis import (build_study_cache, load_study_cache, to_niimg,
+                           activation_frequency, term_meta_analyses)
 
 
 #def url_get(url):
@@ -22,10 +26,27 @@ from neurosynth.analysis import meta
 
 
 if __name__ == '__main__':
-    dataset = Dataset('/volatile/varoquau/dev/neurosynth-data/database.txt')
-    ids = dataset.image_table.ids
-    ma = meta.MetaAnalysis(dataset, ids)
-    ma.save_results(prefix='all_neurosynth')
+    data_dir = '/volatile/varoquau/dev/neurosynth-data'
+    # The activations of the studies, and the studies of each term, are
+    # extracted from the dataset once (remove the file to rebuild it)
+    cache_file = '/tmp/neurovault_analysis/neurosynth_studies.npz'
+    if not os.path.exists(cache_file):
+        dataset = Dataset(os.path.join(data_dir, 'database.txt'))
+        dataset.add_features(os.path.join(data_dir, 'features.txt'))
+        build_study_cache(dataset, cache_file)
+    cache = load_study_cache(cache_file)
+
+    to_niimg(activation_frequency(cache.activations),
+             cache).to_filename('all_neurosynth_pA.nii.gz')
+
+    # The meta-analyses of terms, run in parallel
+    terms = ['response inhibition']
+    images = ('pFgA_z_FDR_0.01', )
+    maps = term_meta_analyses(cache_file, terms, images=images, n_jobs=4)
+    for name in images:
+        for term, values in zip(terms, maps[name]):
+            to_niimg(values, cache).to_filename('%s_%s.nii.gz'
+                                                % (term, name))
 
     #mem.clear()
     #combined_df = mem.cache(get_images_with_collections_df)()
@@ -6,33 +6,35 @@ import seaborn as sns
 sns.set_style("whitegrid")
 
 from matplotlib import pyplot as plt
-from nilearn.input_data import NiftiMasker
 from sklearn.preprocessing import LabelEncoder
 
+from joblib import Memory
+
+from data_matrix import load_data_matrix, data_hash
+from decomposition import compute_embedding
+from metadata_store import load_metadata
+from text_analysis import (GROUP_NAMES, IMAGE_TEXT_COLUMNS, extract_documents,
+                           vectorize)
+
 # -------------------------------------------
 # loading data and metadata
 
 data_dir = "/tmp/neurovault_analysis"
 mask = 'gm_mask.nii.gz'
 
-metadata = pd.DataFrame.from_csv(os.path.join(data_dir, 'metadata.csv'))
+metadata = load_metadata(os.path.join(data_dir, 'metadata'),
+                         columns=['image_id', 'collection_id']
+                                 + list(IMAGE_TEXT_COLUMNS))
 
 # replace NaNs by unknown
 metadata.fillna('unknown')
 
 # can choose another target field here
-target = metadata['collection_id'].values
+target = np.asarray(metadata['collection_id'])
 le = LabelEncoder()
 y = le.fit_transform(target)
 
-images = [os.path.join(data_dir, 'resampled',
-                       '%06d.nii.gz' % row[1]['image_id'])
-          for row in metadata.iterrows()]
-
-masker = NiftiMasker(mask_img=mask, memory=os.path.join(data_dir, 'cache'))
-X = masker.fit_transform(images)
-
-from text_analysis import GROUP_NAMES, extract_documents, vectorize
+X = load_data_matrix(data_dir, mask, image_ids=metadata['image_id'])
 
 documents = extract_documents(metadata)
 term_freq = vectorize(documents)
@@ -104,15 +106,27 @@ def factor_scatter_matrix(df, factor, factor_labels, legend_title=None,
     return axarr, color_map
 
 # -------------------------------------------
-# quick PCA and plotting
+# Embeddings, cached on the hash of the data and their parameters, so
+# that changing the coloring factor does not recompute them
 
-from sklearn.decomposition import PCA
 from pandas.tools.plotting import scatter_matrix
 
-pca = PCA(n_components=3)
-X_pca = pca.fit_transform(X)
+# 'randomized', 'incremental' (for data that does not fit in memory) or
+# 'exact'
+backend = 'randomized'
+plot_tsne = False
+plot_mds = False
+
+mem = Memory(cachedir=os.path.join(data_dir, 'cache'))
+embed = mem.cache(compute_embedding, ignore=['X'])
+data_key = (data_hash(data_dir), list(metadata['image_id']))
 
-df_pca = pd.DataFrame(dict(zip(np.arange(pca.n_components), X_pca.T)))
+# -------------------------------------------
+# quick PCA and plotting
+
+X_pca = embed(X, data_key, 'pca', n_components=3, backend=backend)
+
+df_pca = pd.DataFrame(dict(zip(np.arange(X_pca.shape[1]), X_pca.T)))
 
 scatter_matrix(df_pca, alpha=0.2, figsize=(6, 6), diagonal='kde')
 
@@ -121,30 +135,25 @@ df_pca['label'] = y
 factor_scatter_matrix(df_pca, 'label', le.inverse_transform(list(set(y))),
                       'collection_id')
 
-if 0:
+if plot_tsne:
     # -------------------------------------------
-    # T-SNE
-
-    from sklearn.manifold import TSNE
+    # T-SNE, on the PCA-reduced data
 
-    tsne = TSNE(n_components=3, perplexity=5)
-    X_tsne = tsne.fit_transform(X.astype('float64'))
+    X_tsne = embed(X, data_key, 'tsne', n_components=3, backend=backend,
+                   perplexity=5)
 
-    df_tsne = pd.DataFrame(dict(zip(np.arange(tsne.n_components), X_tsne.T)))
+    df_tsne = pd.DataFrame(dict(zip(np.arange(X_tsne.shape[1]), X_tsne.T)))
     df_tsne['label'] = y
     factor_scatter_matrix(df_tsne, 'label', le.inverse_transform(list(set(y))),
                         'collection_id')
 
-if 0:
+if plot_mds:
     # -------------------------------------------
-    # MSD
-
-    from sklearn.manifold import MDS
+    # MSD, on the PCA-reduced data
 
-    mds = MDS(n_components=3)
-    X_mds = mds.fit_transform(X.astype('float64'))
+    X_mds = embed(X, data_key, 'mds', n_components=3, backend=backend)
 
-    df_mds = pd.DataFrame(dict(zip(np.arange(mds.n_components), X_mds.T)))
+    df_mds = pd.DataFrame(dict(zip(np.arange(X_mds.shape[1]), X_mds.T)))
     df_mds['label'] = y
     factor_scatter_matrix(df_mds, 'label', le.inverse_transform(list(set(y))),
                         'collection_id')
@@ -0,0 +1,113 @@
+""" Resampling of images directly onto the voxels of a mask, with sparse
+interpolation operators computed once per source grid.
+
+Many images share the same grid (eg MNI 2mm or 3mm). For each grid
+(affine and shape), the trilinear interpolation onto the voxels of the
+mask is a sparse (n_mask_voxels, n_source_voxels) matrix: resampling an
+image is then a sparse matrix-vector product, and resampling a batch of
+images on the same grid a single sparse matrix product.
+
+The interpolation is linear, rather than the 'continuous' (cubic spline)
+interpolation of nilearn.image.resample_img: spline interpolation
+requires a prefiltering of the whole image, and has no sparse operator.
+"""
+# License: BSD
+
+import numpy as np
+from scipy import sparse as sp
+from scipy import linalg
+
+
+def interpolation_matrix(source_affine, source_shape, target_affine, mask):
+    """ The sparse matrix of the trilinear interpolation of an image on a
+    source grid at the voxels of a mask on a target grid. Values outside
+    of the source grid are taken as 0.
+    """
+    source_shape = tuple(source_shape[:3])
+    mask = np.asarray(mask, dtype=np.bool)
+    target_ijk = np.array(np.where(mask))
+    n_targets = target_ijk.shape[1]
+    # Target voxels -> world -> source voxels
+    transform = np.dot(linalg.inv(source_affine), target_affine)
+    coords = (np.dot(transform[:3, :3], target_ijk)
+              + transform[:3, 3:])
+    base = np.floor(coords).astype(np.int)
+    frac = coords - base
+
+    rows = list()
+    cols = list()
+    weights = list()
+    target_rows = np.arange(n_targets)
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.array(corner)[:, np.newaxis]
+        ijk = base + corner
+        weight = np.prod(np.where(corner, frac, 1 - frac), axis=0)
+        valid = np.all((ijk >= 0)
+                       & (ijk < np.array(source_shape)[:, np.newaxis]),
+                       axis=0) & (weight > 0)
+        rows.append(target_rows[valid])
+        cols.append(np.ravel_multi_index(ijk[:, valid], source_shape))
+        weights.append(weight[valid])
+    return sp.csr_matrix((np.concatenate(weights),
+                          (np.concatenate(rows), np.concatenate(cols))),
+                         shape=(n_targets, int(np.prod(source_shape))))
+
+
+def _grid_key(affine, shape):
+    return (tuple(np.round(np.asarray(affine), 6).ravel()),
+            tuple(shape[:3]))
+
+
+class ResamplingPlans(object):
+    """ Interpolation operators onto the voxels of a mask, computed once
+    per source grid
+
+    Parameters
+    ----------
+    target_affine: array, (4, 4)
+        The affine of the mask
+    mask: 3D boolean array
+        The voxels to resample to
+    """
+
+    def __init__(self, target_affine, mask):
+        self.target_affine = np.asarray(target_affine)
+        self.mask = np.asarray(mask, dtype=np.bool)
+        self.plans = dict()
+
+    def get(self, affine, shape):
+        """ The interpolation operator for a source grid """
+        key = _grid_key(affine, shape)
+        if not key in self.plans:
+            self.plans[key] = interpolation_matrix(affine, shape,
+                                                   self.target_affine,
+                                                   self.mask)
+        return self.plans[key]
+
+    def resample(self, niimgs):
+        """ Resample 3D or 4D images onto the voxels of the mask
+
+        Images sharing a grid are resampled together, in one matrix
+        product. Returns, for each image, a (n_volumes, n_mask_voxels)
+        array.
+        """
+        groups = dict()
+        for idx, niimg in enumerate(niimgs):
+            groups.setdefault(_grid_key(niimg.get_affine(), niimg.shape),
+                              list()).append(idx)
+        out = [None] * len(niimgs)
+        for indices in groups.values():
+            first = niimgs[indices[0]]
+            plan = self.get(first.get_affine(), first.shape)
+            # One column per volume, voxels in C order
+            columns = [np.asarray(niimgs[idx].get_data(),
+                                  dtype=np.float32).reshape(
+                                        (plan.shape[1], -1))
+                       for idx in indices]
+            resampled = plan.dot(np.hstack(columns)).T
+            start = 0
+            for idx, these_columns in zip(indices, columns):
+                stop = start + these_columns.shape[1]
+                out[idx] = resampled[start:stop]
+                start = stop
+        return out
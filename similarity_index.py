@@ -0,0 +1,309 @@
+""" An index of the masked maps, to find the maps most correlated to given
+maps (eg near duplicates, or the maps similar to a new one).
+
+The rows of the data matrix are z-scored, scaled to unit norm, and
+stored as float32, so that the correlation of two maps is the dot
+product of their rows. They can be reduced with a sparse random
+projection, which preserves the correlations approximately, and makes
+the index much smaller than the data matrix.
+
+Queries are answered, for batches of maps:
+
+* exactly, by blocked matrix products with all the rows
+* approximately, by an inverted file: the rows are clustered with
+  k-means, and only the rows of the clusters closest to the query are
+  compared to it
+
+The index is stored in a directory: 'rows.npy', memory-mapped, and
+'index.json', a header giving the image_id of each row, the hashes of
+the mask and of the data matrix, and the parameters of the projection.
+The sparse projection matrix is stored in 'projection.npz', and the
+clusters in 'centroids.npy', 'lists.npy' and 'list_offsets.npy'.
+"""
+# License: BSD
+
+import os
+import json
+
+import numpy as np
+from scipy import sparse as sp
+import nibabel as nb
+
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.random_projection import SparseRandomProjection
+
+from data_matrix import (load_data_matrix, read_header, data_hash,
+                         mask_hash, standardize_rows)
+from frequency_map import load_in_target
+from fileutils import mkdir_p, tmp_filename, write_json
+
+
+def _projection(n_features, n_components, random_state):
+    """ The sparse (n_components, n_features) random projection matrix:
+    a dense Gaussian one would take gigabytes for a whole brain mask
+    """
+    projection = SparseRandomProjection(n_components=n_components,
+                                        random_state=random_state)
+    # Only the number of features is used
+    projection.fit(sp.csr_matrix((1, n_features)))
+    return sp.csr_matrix(projection.components_, dtype=np.float32)
+
+
+def _save_projection(path, projection):
+    np.savez(os.path.join(path, 'projection.npz'), data=projection.data,
+             indices=projection.indices, indptr=projection.indptr,
+             shape=projection.shape)
+
+
+def _load_projection(path):
+    with np.load(os.path.join(path, 'projection.npz')) as npz:
+        return sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                             shape=tuple(npz['shape']))
+
+
+def _project(X, projection):
+    return np.asarray(projection.dot(np.asarray(X).T).T, dtype=np.float32)
+
+
+def _normalize(X):
+    norms = np.sqrt((X ** 2).sum(axis=1))
+    norms[norms == 0] = 1
+    return X / norms[:, np.newaxis]
+
+
+def _top_k(scores, indices, k):
+    """ The k best scores of each row, and their indices, sorted """
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(scores))[:, np.newaxis]
+    scores, indices = scores[rows, best], indices[rows, best]
+    order = np.argsort(-scores, axis=1)
+    return scores[rows, order], indices[rows, order]
+
+
+def build_index(data_dir, mask_img, path=None, n_components=None,
+                n_lists=None, block_size=2000, random_state=0):
+    """ Build the index of the data matrix of data_dir
+
+    Parameters
+    ----------
+    data_dir: string
+        The directory of the data matrix
+    mask_img: string
+        The mask of the data matrix
+    path: string, optional
+        The directory of the index (data_dir/similarity_index if None)
+    n_components: int, optional
+        The dimension of the random projection. If None, the rows are
+        not projected.
+    n_lists: int or 'auto', optional
+        The number of clusters of the inverted file, for approximate
+        queries ('auto' is the square root of the number of maps). If
+        None, only exact queries are possible.
+    block_size: int
+        The number of rows processed at once
+    random_state: int
+        The seed of the projection and of the k-means
+    """
+    if path is None:
+        path = os.path.join(data_dir, 'similarity_index')
+    mkdir_p(path)
+    X = load_data_matrix(data_dir, mask_img)
+    n_samples, n_features = X.shape
+    projection = None
+    if n_components is not None:
+        projection = _projection(n_features, n_components, random_state)
+        _save_projection(path, projection)
+
+    tmp_file = tmp_filename(os.path.join(path, 'rows.npy'))
+    rows = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                     shape=(n_samples,
+                                            n_components or n_features))
+    for start in range(0, n_samples, block_size):
+        block = standardize_rows(X[start:start + block_size])
+        if projection is not None:
+            block = _project(block, projection)
+        rows[start:start + len(block)] = _normalize(block)
+    rows.flush()
+    os.rename(tmp_file, os.path.join(path, 'rows.npy'))
+
+    if n_lists == 'auto':
+        n_lists = max(1, int(np.sqrt(n_samples)))
+    if n_lists is not None:
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=block_size,
+                                 random_state=random_state)
+        for start in range(0, n_samples, block_size):
+            kmeans.partial_fit(rows[start:start + block_size])
+        centroids = _normalize(kmeans.cluster_centers_.astype(np.float32))
+        labels = np.concatenate([
+                        np.argmax(np.dot(rows[start:start + block_size],
+                                         centroids.T), axis=1)
+                        for start in range(0, n_samples, block_size)])
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        # The rows of each list, contiguous
+        np.save(os.path.join(path, 'lists.npy'),
+                np.argsort(labels, kind='mergesort').astype(np.int64))
+        np.save(os.path.join(path, 'list_offsets.npy'),
+                np.concatenate([[0], np.cumsum(np.bincount(
+                                        labels, minlength=n_lists))]))
+    del rows
+
+    data_header = read_header(data_dir)
+    header = dict(image_ids=data_header['image_ids'],
+                  mask_hash=mask_hash(mask_img),
+                  data_hash=data_hash(data_dir),
+                  n_features=n_features, n_components=n_components,
+                  n_lists=n_lists, random_state=random_state)
+    write_json(os.path.join(path, 'index.json'), header)
+    return path
+
+
+class SimilarityIndex(object):
+    """ Find the maps of the index most correlated to query maps
+
+    Parameters
+    ----------
+    path: string
+        The directory of the index (see build_index)
+    mask_img: string
+        The mask of the data matrix the index was built from
+    block_size: int
+        The number of rows compared to the queries at once, in exact
+        queries
+    """
+
+    def __init__(self, path, mask_img, block_size=10000):
+        with open(os.path.join(path, 'index.json')) as f:
+            self.header = json.load(f)
+        if self.header['mask_hash'] != mask_hash(mask_img):
+            raise ValueError('The index in %s was built with another mask '
+                             'than %s' % (path, mask_img))
+        self.path = path
+        self.mask_img = mask_img
+        self.block_size = block_size
+        self.image_ids = np.asarray(self.header['image_ids'])
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        self.projection = None
+        if self.header['n_components'] is not None:
+            self.projection = _load_projection(path)
+        self.centroids = None
+        if self.header['n_lists'] is not None:
+            self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+            self.lists = np.load(os.path.join(path, 'lists.npy'))
+            self.list_offsets = np.load(os.path.join(path,
+                                                     'list_offsets.npy'))
+
+    def transform(self, X):
+        """ The rows of the index of masked maps X """
+        X = standardize_rows(np.atleast_2d(X))
+        if self.projection is not None:
+            X = _project(X, self.projection)
+        return _normalize(X)
+
+    def _exact(self, queries, k):
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.rows), self.block_size):
+            block = np.asarray(self.rows[start:start + self.block_size])
+            scores = np.dot(queries, block.T)
+            rows = np.tile(np.arange(start, start + len(block)),
+                           (len(queries), 1))
+            best_scores, best_rows = _top_k(
+                                np.hstack([best_scores, scores]),
+                                np.hstack([best_rows, rows]), k)
+        return best_scores, best_rows
+
+    def _approximate(self, queries, k, n_probe):
+        lists = np.argsort(-np.dot(queries, self.centroids.T),
+                           axis=1)[:, :n_probe]
+        all_scores = np.zeros((len(queries), k), dtype=np.float32)
+        all_rows = np.zeros((len(queries), k), dtype=np.int64)
+        # Padding, for queries with less than k candidates
+        all_scores.fill(-np.inf)
+        all_rows.fill(-1)
+        for idx, (query, these_lists) in enumerate(zip(queries, lists)):
+            candidates = np.sort(np.concatenate([
+                            self.lists[self.list_offsets[l]:
+                                       self.list_offsets[l + 1]]
+                            for l in these_lists]))
+            if not len(candidates):
+                continue
+            scores = np.dot(self.rows[candidates], query)
+            scores, rows = _top_k(scores[np.newaxis], candidates[np.newaxis],
+                                  k)
+            all_scores[idx, :scores.shape[1]] = scores[0]
+            all_rows[idx, :rows.shape[1]] = rows[0]
+        return all_scores, all_rows
+
+    def query(self, X, k=10, exact=True, n_probe=8):
+        """ The k maps of the index most correlated to each of the masked
+        maps X
+
+        Parameters
+        ----------
+        X: array, (n_queries, n_voxels)
+            The maps, masked
+        k: int
+            The number of maps returned for each query
+        exact: boolean
+            If False, only the rows of the n_probe clusters closest to
+            each query are searched (the index must have been built with
+            n_lists)
+        n_probe: int
+            The number of clusters searched in approximate queries
+
+        Returns
+        -------
+        image_ids: array, (n_queries, k)
+            The image_ids of the maps found, best first (-1 for missing
+            results of approximate queries)
+        scores: array, (n_queries, k)
+            Their correlations with the queries (approximate if the index
+            is projected)
+        """
+        queries = self.transform(X)
+        if exact:
+            scores, rows = self._exact(queries, k)
+        else:
+            if self.centroids is None:
+                raise ValueError('The index in %s was built without '
+                                 'clusters: only exact queries are '
+                                 'possible' % self.path)
+            scores, rows = self._approximate(queries, k, n_probe)
+        image_ids = np.where(rows >= 0, self.image_ids[rows], -1)
+        return image_ids, scores
+
+    def query_images(self, imgs, k=10, **kwargs):
+        """ Query with NIfTI files of 3D maps: they are resampled to the
+        mask if needed. See query for the parameters.
+        """
+        mask_nii = nb.load(self.mask_img)
+        mask = mask_nii.get_data().astype(np.bool)
+        X = [load_in_target(img, mask_nii.get_affine(), mask.shape,
+                            interpolation='continuous').squeeze()[mask]
+             for img in imgs]
+        return self.query(np.array(X), k=k, **kwargs)
+
+    def query_ids(self, image_ids, k=10, data_dir=None, exclude_self=True,
+                  **kwargs):
+        """ Query with maps of the data matrix, given by image_id. The
+        maps themselves are excluded from their results, unless
+        exclude_self is False. See query for the parameters.
+        """
+        if data_dir is None:
+            data_dir = os.path.dirname(os.path.abspath(self.path))
+        X = load_data_matrix(data_dir, self.mask_img, image_ids=image_ids)
+        found_ids, scores = self.query(X, k=k + bool(exclude_self),
+                                       **kwargs)
+        if not exclude_self:
+            return found_ids, scores
+        n_found = min(k, found_ids.shape[1] - 1)
+        out_ids = np.empty((len(found_ids), n_found), dtype=found_ids.dtype)
+        out_scores = np.empty((len(found_ids), n_found), dtype=scores.dtype)
+        for idx, image_id in enumerate(image_ids):
+            keep = found_ids[idx] != int(image_id)
+            # Drop the last result if the map was not found
+            keep[np.where(keep)[0][n_found:]] = False
+            out_ids[idx] = found_ids[idx][keep]
+            out_scores[idx] = scores[idx][keep]
+        return out_ids, out_scores
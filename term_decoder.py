@@ -0,0 +1,203 @@
+""" Decoding of the maps offline, against a local matrix of term maps.
+
+NeuroSynth decodes an image by correlating it, over the voxels, with the
+reverse inference map ('pFgA_z') of each term. Here the maps of the
+terms are computed once, with the meta-analyses of meta_analysis,
+restricted to the voxels of the mask, and stored as a (n_terms, n_voxels)
+float32 matrix.
+Decoding a batch of images is then a single product of the standardized
+images with the standardized term maps.
+
+The term maps are stored standardized in a directory, as
+'term_maps.npy', so that the decoder memory-maps them as they are, with
+a 'term_maps.json' header giving the terms, the hash of the mask and the
+hash of the maps. To build them from a NeuroSynth database (with a study
+cache, see meta_analysis):
+
+    python term_decoder.py database.txt features.txt term_maps/
+"""
+# License: BSD
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import nibabel as nb
+
+from nilearn.image import resample_img
+
+from data_matrix import mask_hash, iter_volumes, standardize_rows
+from fileutils import mkdir_p, tmp_filename, write_json
+from meta_analysis import (build_study_cache, load_study_cache, to_niimg,
+                           term_meta_analyses)
+
+
+def _in_mask(data, affine, mask_nii):
+    """ The values of a 3D array at the voxels of the mask """
+    mask = mask_nii.get_data().astype(np.bool)
+    if (data.shape[:3] != mask.shape
+            or not np.allclose(affine, mask_nii.get_affine())):
+        data = resample_img(nb.Nifti1Image(data, affine),
+                            mask_nii.get_affine(), mask.shape).get_data()
+    return data[mask]
+
+
+def build_term_maps(cache_file, mask_img, terms=None, image='pFgA_z',
+                    n_jobs=1):
+    """ Compute the maps of terms with NeuroSynth meta-analyses, at the
+    voxels of the mask
+
+    Parameters
+    ----------
+    cache_file: string
+        The study cache of a NeuroSynth dataset (see
+        meta_analysis.build_study_cache)
+    mask_img: string
+        The mask of the analysis
+    terms: list of strings, optional
+        The terms (all the features of the dataset if None)
+    image: string
+        The map of the meta-analysis used
+    n_jobs: int
+        The number of processes running the meta-analyses
+
+    Returns
+    -------
+    term_maps: array, (n_terms, n_voxels)
+    terms: list of strings
+    """
+    cache = load_study_cache(cache_file)
+    if terms is None:
+        terms = cache.features
+    maps = term_meta_analyses(cache_file, terms, images=(image, ),
+                              n_jobs=n_jobs)[image]
+    mask_nii = nb.load(mask_img)
+    term_maps = np.empty((len(terms),
+                          mask_nii.get_data().astype(np.bool).sum()),
+                         dtype=np.float32)
+    for idx, values in enumerate(maps):
+        niimg = to_niimg(values, cache)
+        term_maps[idx] = _in_mask(niimg.get_data(), niimg.get_affine(),
+                                  mask_nii)
+    return term_maps, list(terms)
+
+
+def save_term_maps(term_maps, terms, mask_img, path):
+    """ Save the term maps, computed at the voxels of the mask, in the
+    directory path. They are saved standardized.
+    """
+    mkdir_p(path)
+    term_maps = standardize_rows(term_maps)
+    tmp_file = tmp_filename(os.path.join(path, 'term_maps.npy'))
+    np.save(tmp_file, term_maps)
+    os.rename(tmp_file, os.path.join(path, 'term_maps.npy'))
+    header = dict(terms=list(terms), mask_hash=mask_hash(mask_img),
+                  standardized=True,
+                  maps_hash=hashlib.sha1(np.ascontiguousarray(
+                                            term_maps).tostring()
+                                         ).hexdigest())
+    write_json(os.path.join(path, 'term_maps.json'), header)
+
+
+def read_term_maps_header(path):
+    with open(os.path.join(path, 'term_maps.json')) as f:
+        return json.load(f)
+
+
+class TermDecoder(object):
+    """ Decode images by their correlation with the maps of terms
+
+    Parameters
+    ----------
+    term_maps: array, (n_terms, n_voxels)
+        The maps of the terms, at the voxels of the mask
+    terms: list of strings
+        The terms
+    batch_size: int
+        The number of images decoded at once
+    standardized: boolean
+        Whether the term maps are already standardized (as saved by
+        save_term_maps): they are then used as they are, eg
+        memory-mapped, rather than copied
+    """
+
+    def __init__(self, term_maps, terms, batch_size=500,
+                 standardized=False):
+        self.terms = list(terms)
+        self.batch_size = batch_size
+        if standardized:
+            self.term_maps_ = term_maps
+        else:
+            # Standardized once for all the images
+            self.term_maps_ = standardize_rows(term_maps)
+
+    @classmethod
+    def load(cls, path, mask_img, batch_size=500):
+        """ The decoder of the term maps saved in path, for the given
+        mask: it must be the one the maps were computed with
+        """
+        header = read_term_maps_header(path)
+        if header['mask_hash'] != mask_hash(mask_img):
+            raise ValueError('The term maps in %s were computed with '
+                             'another mask than %s' % (path, mask_img))
+        term_maps = np.load(os.path.join(path, 'term_maps.npy'),
+                            mmap_mode='r')
+        # Maps saved by older versions are not standardized
+        return cls(term_maps, header['terms'], batch_size=batch_size,
+                   standardized=header.get('standardized', False))
+
+    def decode(self, X):
+        """ The (n_images, n_terms) correlations of the masked images X
+        (eg the data matrix) with the maps of the terms
+        """
+        n_voxels = self.term_maps_.shape[1]
+        scores = np.empty((len(X), len(self.terms)), dtype=np.float32)
+        for start in range(0, len(X), self.batch_size):
+            batch = standardize_rows(X[start:start + self.batch_size])
+            scores[start:start + len(batch)] = np.dot(
+                                batch, self.term_maps_.T) / n_voxels
+        return scores
+
+    def decode_files(self, files, mask_img, volumes=None, n_jobs=1):
+        """ Decode images (or volumes of 4D images) given by files, in the
+        space of the mask. Files are read by n_jobs threads.
+        """
+        mask = nb.load(mask_img).get_data().astype(np.bool)
+        scores = list()
+        batch = list()
+        for data in iter_volumes(list(files), volumes, n_jobs=n_jobs):
+            batch.append(data[mask])
+            if len(batch) == self.batch_size:
+                scores.append(self.decode(np.array(batch)))
+                batch = list()
+        if batch:
+            scores.append(self.decode(np.array(batch)))
+        if not scores:
+            return np.empty((0, len(self.terms)), dtype=np.float32)
+        return np.concatenate(scores)
+
+
+if __name__ == '__main__':
+    from neurosynth.base.dataset import Dataset
+
+    parser = argparse.ArgumentParser(
+        description='Compute the term maps of the local decoder')
+    parser.add_argument('database', help='the NeuroSynth database file')
+    parser.add_argument('features', help='the NeuroSynth features file')
+    parser.add_argument('output', help='the directory of the term maps')
+    parser.add_argument('--mask', default='gm_mask.nii.gz')
+    parser.add_argument('--jobs', type=int, default=1)
+    args = parser.parse_args(sys.argv[1:])
+
+    cache_file = os.path.join(args.output, 'neurosynth_studies.npz')
+    if not os.path.exists(cache_file):
+        dataset = Dataset(args.database)
+        dataset.add_features(args.features)
+        mkdir_p(args.output)
+        build_study_cache(dataset, cache_file)
+    term_maps, terms = build_term_maps(cache_file, args.mask,
+                                       n_jobs=args.jobs)
+    save_term_maps(term_maps, terms, args.mask, args.output)
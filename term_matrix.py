@@ -0,0 +1,52 @@
+""" Storage of the sparse (n_images, n_terms) matrix of NeuroSynth term
+scores, as a compressed .npz file indexed by image_id.
+"""
+# License: BSD
+
+import numpy as np
+from scipy import sparse as sp
+
+
+def save_term_matrix(filename, X, terms, image_ids):
+    X = sp.csr_matrix(X)
+    np.savez_compressed(filename, data=X.data, indices=X.indices,
+                        indptr=X.indptr, shape=X.shape,
+                        terms=np.array(terms, dtype=np.unicode_),
+                        image_ids=np.asarray(image_ids, dtype=np.int))
+
+
+def load_term_matrix(filename, image_ids=None):
+    """ Returns the sparse matrix, the list of terms and the image_ids of
+    its rows
+
+    If image_ids are given, the rows returned are those of these images,
+    in this order (empty rows for images that are not in the file).
+    """
+    with np.load(filename) as npz:
+        X = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                          shape=tuple(npz['shape']))
+        terms = list(npz['terms'])
+        file_ids = npz['image_ids']
+    if image_ids is None:
+        return X, terms, file_ids
+
+    rows = dict((image_id, row) for row, image_id in enumerate(file_ids))
+    selection = [(idx, rows[int(image_id)])
+                 for idx, image_id in enumerate(image_ids)
+                 if int(image_id) in rows]
+    # Select (and reorder) the rows with a sparse product
+    select = sp.csr_matrix((np.ones(len(selection)),
+                            ([s[0] for s in selection],
+                             [s[1] for s in selection])),
+                           shape=(len(image_ids), X.shape[0]))
+    return select.dot(X).tocsr(), terms, np.asarray(image_ids)
+
+
+def clip_negative(X):
+    """ A copy of the sparse matrix X with its negative entries removed:
+    terms that have a negative correlation are not present in a map
+    """
+    X = sp.csr_matrix(X, copy=True)
+    X.data[X.data < 0] = 0
+    X.eliminate_zeros()
+    return X
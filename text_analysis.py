@@ -6,6 +6,7 @@
 import re
 
 import numpy as np
+from scipy import sparse as sp
 
 
 # Groups of terms that appear often (careful to only have double spaces)
@@ -30,57 +31,83 @@ GROUP_NAMES = ('language', 'audio', 'motor', 'hand', 'visual terms',
                'objects')
 
 
+# The columns of the metadata used to build the documents
+IMAGE_TEXT_COLUMNS = ('description_image', 'name_image',
+                      'contrast_definition', 'contrast_definition_cogatlas')
+COLLECTION_TEXT_COLUMNS = ('description_collection', 'name_collection')
+
+
+def _index_words(groups):
+    """ For each word, the indices of the groups it belongs to """
+    word_groups = dict()
+    for group_idx, this_group in enumerate(groups):
+        for word in this_group:
+            word_groups.setdefault(word, list()).append(group_idx)
+    return word_groups
+
+WORD_GROUPS = _index_words(GROUPS)
+
+PUNCTUATION = re.compile(r"[_.;,:!?'()]")
+CONTRAST = re.compile('(-|>|vs).*$')
+SPACES = re.compile(r'\s+')
+
+
 def to_str(value):
     if isinstance(value, float):
         return ''
     else:
-        value = str(value).replace('.nii', '').replace('.gz', '')
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        # Text loaded from the metadata store is unicode: no str(), that
+        # fails on non-ASCII characters
+        value = value.replace('.nii', '').replace('.gz', '')
         value = value.lower()
         value = ' %s ' % value
-        exp = re.compile(r"[_.;,:!?'()]")
-        value = exp.sub(' ', value)
+        value = PUNCTUATION.sub(' ', value)
         #for word in exclude_words:
         #    value = value.replace(' %s ' % word, ' ')
         return value
 
 
 def extract_documents(metadata, collection_data=False):
-    documents = []
     def my_to_str(x):
-        return re.sub('(-|>|vs).*$', ' ', to_str(x))
-    for _, row in metadata.iterrows():
-        this_doc = [my_to_str(row.description_image),
-                    my_to_str(row.name_image),
-                    my_to_str(row.contrast_definition),
-                    my_to_str(row.contrast_definition_cogatlas)]
-        if collection_data:
-            # Repeat the 3 time image-specific info, to give them more weight
-            this_doc = 3 * this_doc
-            this_doc.extend((to_str(row.description_collection),
-                             to_str(row.name_collection)))
-
+        return CONTRAST.sub(' ', to_str(x))
+    # Work column by column, rather than row by row
+    columns = [list(metadata[name].map(my_to_str))
+               for name in IMAGE_TEXT_COLUMNS]
+    if collection_data:
+        # Repeat the 3 time image-specific info, to give them more weight
+        columns = 3 * columns
+        columns.extend(list(metadata[name].map(to_str))
+                       for name in COLLECTION_TEXT_COLUMNS)
+    documents = []
+    for this_doc in zip(*columns):
         this_doc = ' '.join(this_doc)
         # Replace '>' by ' '
         # Replace spaces by 2 consecutive spaces, to make life easier for
         # the matching code that follows
-        this_doc = ' %s ' % re.sub(r'\s+', '  ', this_doc)
+        this_doc = ' %s ' % SPACES.sub('  ', this_doc)
         documents.append(this_doc)
     return documents
 
 
-def vectorize(documents):
-    # A hand-code vectorizer (probably horrible):
-    X = []
-    for this_doc in documents:
-        this_x = list()
-        for this_group in GROUPS:
-            this_count = 0
-            for word in this_group:
-                this_count += len(re.compile(' %s ' % word).findall(this_doc))
-            this_x.append(this_count)
-        X.append(this_x)
-
-    X = np.array(X)
-    return X
-
-
+def vectorize(documents, sparse=False):
+    """ Count the occurrences of the words of each group of GROUPS in
+    each document: returns a (n_documents, n_groups) array, or a sparse
+    matrix if sparse is True.
+    """
+    # Each document is tokenized once, and each token looked up in the
+    # index of the words of the groups
+    rows = list()
+    cols = list()
+    for doc_idx, this_doc in enumerate(documents):
+        for token in this_doc.split():
+            for group_idx in WORD_GROUPS.get(token, ()):
+                rows.append(doc_idx)
+                cols.append(group_idx)
+    # Duplicate entries are summed
+    X = sp.coo_matrix((np.ones(len(rows), dtype=np.int), (rows, cols)),
+                      shape=(len(documents), len(GROUPS))).tocsr()
+    if sparse:
+        return X
+    return X.toarray()